@@ -0,0 +1,132 @@
+import argparse
+import json
+import statistics
+import time
+
+import requests
+from sqlalchemy.orm import Session
+
+from database import engine
+from eta_engine import ETAEngine
+from gtfs_realtime_pb2 import FeedMessage
+
+# Offline accuracy and throughput benchmark for the ETA engine.
+#
+# Record position history from the live feed (one JSON line per tick):
+#   python benchmark_eta.py record history.jsonl --interval 15 --duration 3600
+# Replay it through the engine against the static tables in the database:
+#   python benchmark_eta.py replay history.jsonl
+#
+# Accuracy is measured by comparing each prediction with the arrival the
+# engine later observes when the vehicle passes the stop, bucketed by how
+# far ahead the prediction was made.
+
+HORIZON_BUCKETS = [(0, 300), (300, 600), (600, 1200), (1200, 1800), (1800, None)]
+
+
+def record(url, path, interval, duration):
+    deadline = time.time() + duration
+    ticks = 0
+    with open(path, "a") as out:
+        while time.time() < deadline:
+            response = requests.get(url)
+            response.raise_for_status()
+            feed = FeedMessage()
+            feed.ParseFromString(response.content)
+            positions = [
+                {
+                    "vehicle_id": entity.vehicle.vehicle.id,
+                    "trip_id": entity.vehicle.trip.trip_id,
+                    "timestamp": entity.vehicle.timestamp or feed.header.timestamp,
+                    "latitude": entity.vehicle.position.latitude,
+                    "longitude": entity.vehicle.position.longitude,
+                }
+                for entity in feed.entity
+                if entity.HasField("vehicle")
+            ]
+            out.write(json.dumps({"timestamp": feed.header.timestamp, "positions": positions}) + "\n")
+            out.flush()
+            ticks += 1
+            time.sleep(interval)
+    print(f"Recorded {ticks} ticks to {path}")
+
+
+def replay(path):
+    eta = ETAEngine()
+    started = time.perf_counter()
+    with Session(engine) as db:
+        eta.load(db)
+    print(f"Loaded {len(eta.trips)} trips and {len(eta.shapes)} shapes in {time.perf_counter() - started:.2f}s")
+
+    with open(path) as f:
+        ticks = [json.loads(line) for line in f if line.strip()]
+
+    # (trip_id, stop_id) -> list of (made_at, predicted_arrival)
+    pending = {}
+    errors = {bucket: [] for bucket in HORIZON_BUCKETS}
+    tick_times = []
+    positions_seen = 0
+
+    for tick in ticks:
+        now = tick["timestamp"]
+        started = time.perf_counter()
+        arrivals = eta.update(tick["positions"], now=now)
+        tick_times.append(time.perf_counter() - started)
+        positions_seen += len(tick["positions"])
+
+        for trip_id, stop_id, actual in arrivals:
+            for made_at, predicted in pending.pop((trip_id, stop_id), []):
+                horizon = actual - made_at
+                for bucket in HORIZON_BUCKETS:
+                    low, high = bucket
+                    if horizon >= low and (high is None or horizon < high):
+                        errors[bucket].append(predicted - actual)
+                        break
+
+        for prediction in eta.by_trip.values():
+            for stop in prediction["stops"]:
+                pending.setdefault((prediction["trip_id"], stop["stop_id"]), []).append(
+                    (now, stop["predicted_arrival"])
+                )
+
+    total = sum(tick_times)
+    print(f"Replayed {len(ticks)} ticks, {positions_seen} positions in {total:.3f}s")
+    if tick_times:
+        print(
+            f"  per tick: mean {statistics.mean(tick_times) * 1000:.2f} ms, "
+            f"max {max(tick_times) * 1000:.2f} ms, {positions_seen / total if total else 0:.0f} positions/s"
+        )
+    print(f"  engine stats: {eta.stats}")
+
+    print("Accuracy by prediction horizon (error = predicted - actual, seconds):")
+    for (low, high), values in errors.items():
+        label = f"{low // 60}-{high // 60} min" if high is not None else f"{low // 60}+ min"
+        if not values:
+            print(f"  {label:>10}: no samples")
+            continue
+        absolute = sorted(abs(v) for v in values)
+        print(
+            f"  {label:>10}: n={len(values)} bias={statistics.mean(values):.0f} "
+            f"MAE={statistics.mean(absolute):.0f} p90={absolute[int(0.9 * (len(absolute) - 1))]:.0f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ETA engine benchmark")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    record_parser = commands.add_parser("record", help="Record vehicle positions history")
+    record_parser.add_argument("path")
+    record_parser.add_argument("--interval", type=float, default=15)
+    record_parser.add_argument("--duration", type=float, default=3600)
+
+    replay_parser = commands.add_parser("replay", help="Replay recorded history through the engine")
+    replay_parser.add_argument("path")
+
+    args = parser.parse_args()
+    if args.command == "record":
+        from envConfig import GTFS_REAL_TIME_POSITION_UPDATES_URL
+
+        record(GTFS_REAL_TIME_POSITION_UPDATES_URL, args.path, args.interval, args.duration)
+    else:
+        replay(args.path)
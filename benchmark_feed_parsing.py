@@ -0,0 +1,190 @@
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+
+from feed_snapshot import FeedParser, diff_snapshots, parse_vehicle_positions
+from gtfs_realtime_pb2 import FeedMessage
+
+# Event-loop stall benchmark for GTFS-realtime parsing.
+#
+#   python benchmark_feed_parsing.py --vehicles 20000 --rounds 10
+#
+# A heartbeat task wakes up every millisecond and records how late it was
+# woken. Each mode parses the same large synthetic vehicle positions feed:
+#   inline  - ParseFromString and the entity loop on the event loop thread
+#   thread  - parse_vehicle_positions in a thread pool
+#   process - parse_vehicle_positions in a process pool
+# The worst and total heartbeat lateness is the time the loop was blocked.
+# The positions listener (enrichment of changed vehicles and serialization
+# of the shared snapshot) is measured the same way, inline and in a thread.
+
+HEARTBEAT_INTERVAL = 0.001
+# Report time of vehicles that did not move between synthetic feeds
+STALE_TIMESTAMP = 1_600_000_000
+
+
+def synthetic_feed(vehicles, header_timestamp, moved_fraction=1.0, seed=0):
+    rng = random.Random(seed)
+    feed = FeedMessage()
+    feed.header.gtfs_realtime_version = "2.0"
+    feed.header.timestamp = header_timestamp
+    for i in range(vehicles):
+        entity = feed.entity.add()
+        entity.id = f"vehicle-{i}"
+        entity.vehicle.vehicle.id = str(i)
+        entity.vehicle.trip.trip_id = f"trip-{i % 2000}"
+        entity.vehicle.trip.route_id = f"route-{i % 150}"
+        moved = rng.random() < moved_fraction
+        entity.vehicle.position.latitude = 39.1 + (i % 500) * 0.0005 + (0.0001 if moved else 0.0)
+        entity.vehicle.position.longitude = -86.5 + (i // 500) * 0.0005
+        entity.vehicle.position.bearing = float(i % 360)
+        entity.vehicle.timestamp = header_timestamp if moved else STALE_TIMESTAMP
+    return feed.SerializeToString()
+
+
+def parse_inline(content):
+    # Mirrors the original handler: decode and walk every entity on the loop
+    feed = FeedMessage()
+    feed.ParseFromString(content)
+    positions = []
+    for entity in feed.entity:
+        if entity.HasField("vehicle"):
+            positions.append(
+                {
+                    "vehicle_id": entity.vehicle.vehicle.id,
+                    "trip_id": entity.vehicle.trip.trip_id,
+                    "latitude": entity.vehicle.position.latitude,
+                    "longitude": entity.vehicle.position.longitude,
+                    "bearing": entity.vehicle.position.bearing,
+                }
+            )
+    return positions
+
+
+def enrich_positions(snapshot, diff, trip_routes, positions_by_entity):
+    # Mirrors main.process_bus_positions without the database and ETA engine
+    for entity_id in diff.removed:
+        positions_by_entity.pop(entity_id, None)
+    for entity_id in diff.upserted:
+        row = snapshot.index[entity_id]
+        position = {
+            "vehicle_id": snapshot.vehicle_ids[row],
+            "trip_id": snapshot.trip_ids[row],
+            "timestamp": int(snapshot.timestamp[row]),
+            "latitude": float(snapshot.latitude[row]),
+            "longitude": float(snapshot.longitude[row]),
+            "bearing": float(snapshot.bearing[row]),
+            **trip_routes[snapshot.trip_ids[row]],
+        }
+        # Encoded per vehicle, so no single call holds the GIL for the whole fleet
+        positions_by_entity[entity_id] = (position, json.dumps(position).encode())
+    positions = [position for position, _ in positions_by_entity.values()]
+    return positions, b"[" + b",".join(encoded for _, encoded in positions_by_entity.values()) + b"]"
+
+
+async def measure_listener(mode, snapshot, diff, rounds):
+    trip_routes = {trip_id: {"route_id": "1", "route_short_name": "1", "route_color": None} for trip_id in snapshot.trip_ids}
+    lateness = []
+    stop = asyncio.Event()
+    beat = asyncio.create_task(heartbeat(lateness, stop))
+    await asyncio.sleep(0.05)
+
+    started = time.perf_counter()
+    for _ in range(rounds):
+        if mode == "inline":
+            enrich_positions(snapshot, diff, trip_routes, {})
+        else:
+            await asyncio.to_thread(enrich_positions, snapshot, diff, trip_routes, {})
+        await asyncio.sleep(0)
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    await beat
+    return elapsed, lateness
+
+
+def print_row(mode, elapsed, lateness, rounds):
+    ordered = sorted(lateness) or [0.0]
+    print(
+        f"{mode:>8} {elapsed / rounds * 1000:>8.1f}ms {ordered[-1] * 1000:>8.1f}ms "
+        f"{ordered[int(0.99 * (len(ordered) - 1))] * 1000:>8.1f}ms {sum(lateness) * 1000:>10.1f}ms"
+    )
+
+
+async def heartbeat(lateness, stop):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        expected = loop.time() + HEARTBEAT_INTERVAL
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        lateness.append(max(0.0, loop.time() - expected))
+
+
+async def measure(mode, content, rounds, parser):
+    lateness = []
+    stop = asyncio.Event()
+    beat = asyncio.create_task(heartbeat(lateness, stop))
+    await asyncio.sleep(0.05)
+
+    started = time.perf_counter()
+    for _ in range(rounds):
+        if mode == "inline":
+            parse_inline(content)
+        else:
+            await parser.parse(parse_vehicle_positions, content)
+        # Let the heartbeat observe the loop between rounds
+        await asyncio.sleep(0)
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    await beat
+    return elapsed, lateness
+
+
+async def main(vehicles, rounds):
+    content = synthetic_feed(vehicles, header_timestamp=1_700_000_000)
+    print(f"Synthetic feed: {vehicles} vehicles, {len(content) / 1024:.0f} KiB, {rounds} rounds")
+
+    parsers = {"inline": None, "thread": FeedParser(use_processes=False), "process": FeedParser(use_processes=True)}
+    # Warm the process pool so worker startup is not counted as a stall
+    await parsers["process"].parse(parse_vehicle_positions, content)
+
+    print(f"{'mode':>8} {'per parse':>10} {'max stall':>10} {'p99 stall':>10} {'total stall':>12}")
+    for mode, parser in parsers.items():
+        elapsed, lateness = await measure(mode, content, rounds, parser)
+        print_row(mode, elapsed, lateness, rounds)
+        if parser is not None:
+            parser.shutdown()
+
+    # Diff cost when a quarter of the fleet reported a new position
+    previous = parse_vehicle_positions(synthetic_feed(vehicles, 1_700_000_000, moved_fraction=0.0))
+    current = parse_vehicle_positions(synthetic_feed(vehicles, 1_700_000_030, moved_fraction=0.25, seed=1))
+    timings = []
+    for _ in range(rounds):
+        previous._index = None
+        current._index = None
+        started = time.perf_counter()
+        diff = diff_snapshots(previous, current)
+        timings.append(time.perf_counter() - started)
+    print(
+        f"Diff: {len(diff.added)} added, {len(diff.changed)} changed, {len(diff.removed)} removed "
+        f"in {statistics.mean(timings) * 1000:.1f}ms"
+    )
+
+    # Listener stall for the first tick, where every vehicle is new
+    print(f"Listener on {len(current)} new vehicles")
+    print(f"{'mode':>8} {'per tick':>10} {'max stall':>10} {'p99 stall':>10} {'total stall':>12}")
+    first_tick = diff_snapshots(None, current)
+    for mode in ("inline", "thread"):
+        elapsed, lateness = await measure_listener(mode, current, first_tick, rounds)
+        print_row(mode, elapsed, lateness, rounds)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Feed parsing event-loop stall benchmark")
+    parser.add_argument("--vehicles", type=int, default=20000)
+    parser.add_argument("--rounds", type=int, default=10)
+    args = parser.parse_args()
+    asyncio.run(main(args.vehicles, args.rounds))
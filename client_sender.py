@@ -0,0 +1,128 @@
+import asyncio
+import time
+from collections import Counter, deque
+
+# Per-client outgoing queue for the bus positions WebSocket.
+# Broadcasting only hands a frame to each client's sender and never awaits
+# the network, so a client on a slow connection cannot delay the others.
+# Position frames are latest-wins: a frame that has not been sent yet is
+# replaced by the newer one and counted as dropped. Control messages (such
+# as subscription errors) go through a small bounded queue ahead of them.
+# Every send has a timeout, and a client that keeps timing out is closed.
+
+# Seconds a single send may take before it counts as a timeout
+SEND_TIMEOUT = 5.0
+# Consecutive send timeouts after which the client is disconnected
+MAX_CONSECUTIVE_TIMEOUTS = 3
+# Control messages waiting to be sent; the oldest is dropped beyond this
+CONTROL_QUEUE_SIZE = 8
+# WebSocket close code sent to clients disconnected for being too slow (try again later)
+SLOW_CLIENT_CLOSE_CODE = 1013
+
+
+class ClientSender:
+    """
+    Sends queued frames to one WebSocket from its own task.
+    """
+
+    def __init__(
+        self,
+        websocket,
+        totals=None,
+        send_timeout=SEND_TIMEOUT,
+        max_consecutive_timeouts=MAX_CONSECUTIVE_TIMEOUTS,
+        control_queue_size=CONTROL_QUEUE_SIZE,
+    ):
+        self.websocket = websocket
+        self.send_timeout = send_timeout
+        self.max_consecutive_timeouts = max_consecutive_timeouts
+        # Counters shared by all senders, next to this client's own
+        self.totals = totals if totals is not None else Counter()
+        self.stats = Counter()
+        self.connected_at = time.time()
+        self.closed = False
+        self._control = deque(maxlen=control_queue_size)
+        self._latest = None
+        self._ready = asyncio.Event()
+        self._consecutive_timeouts = 0
+
+    @property
+    def pending(self):
+        return len(self._control) + (self._latest is not None)
+
+    def _count(self, name, amount=1):
+        self.stats[name] += amount
+        self.totals[name] += amount
+
+    def offer(self, message):
+        """
+        Queue a position frame, replacing one that has not been sent yet.
+        """
+        if self.closed:
+            return
+        if self._latest is not None:
+            self._count("dropped_frames")
+        self._latest = message
+        self._ready.set()
+
+    def offer_control(self, message):
+        """
+        Queue a message that must not be replaced by later position frames.
+        """
+        if self.closed:
+            return
+        if len(self._control) == self._control.maxlen:
+            self._count("dropped_control")
+        self._control.append(message)
+        self._ready.set()
+
+    def _next_message(self):
+        if self._control:
+            return self._control.popleft()
+        message, self._latest = self._latest, None
+        return message
+
+    async def run(self):
+        """
+        Send queued messages until the client is closed or becomes too slow.
+        """
+        while not self.closed:
+            await self._ready.wait()
+            self._ready.clear()
+            while not self.closed and self.pending:
+                message = self._next_message()
+                started = time.perf_counter()
+                try:
+                    await asyncio.wait_for(self.websocket.send_text(message), self.send_timeout)
+                except asyncio.TimeoutError:
+                    self._count("send_timeouts")
+                    self._consecutive_timeouts += 1
+                    if self._consecutive_timeouts >= self.max_consecutive_timeouts:
+                        self._count("slow_disconnects")
+                        await self.close(SLOW_CLIENT_CLOSE_CODE)
+                    continue
+                self._consecutive_timeouts = 0
+                self._count("sent_frames")
+                self.stats["max_send_ms"] = max(
+                    self.stats["max_send_ms"], round((time.perf_counter() - started) * 1000)
+                )
+
+    async def close(self, code=1000):
+        if self.closed:
+            return
+        self.closed = True
+        self._latest = None
+        self._control.clear()
+        self._ready.set()
+        try:
+            await asyncio.wait_for(self.websocket.close(code=code), self.send_timeout)
+        except Exception:
+            # The connection is already gone or too slow to take a close frame
+            pass
+
+    def describe(self):
+        return {
+            "connected_seconds": round(time.time() - self.connected_at),
+            "pending": self.pending,
+            **self.stats,
+        }
@@ -8,6 +8,11 @@ load_dotenv()
 # Retrieve the environment variables as a dictionary
 config_vars = dotenv_values()
 
+# Optional settings, overridden by the .env file when present
+SHARED_SNAPSHOT_DIR = None  # Where worker processes share real-time snapshots
+PROFILE_SAMPLE_RATE = 0  # Fraction of requests profiled, e.g. 0.01
+PROFILE_ADMIN_TOKEN = None  # Enables profiling on demand, the /admin/profiles endpoints and static feed reloads
+
 # Assign each environment variable to a global variable
 for key, value in config_vars.items():
     globals()[key] = value
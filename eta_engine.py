@@ -0,0 +1,418 @@
+import math
+import threading
+import time
+from datetime import datetime
+from itertools import groupby
+from zoneinfo import ZoneInfo
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from models import Agency, ShapeGeometry, Stop, StopTime, Trip
+from shape_geometry import ShapeArrays
+
+# In-process ETA prediction from live vehicle positions.
+# Each vehicle is projected onto its trip's shape to find how far along the
+# trip it is, compared against the static stop_times schedule to get its
+# delay, and that delay is carried forward to the downstream stops.
+# Only vehicles that moved since the previous tick are recomputed.
+
+EARTH_RADIUS_M = 6371000.0
+# Movements smaller than this are treated as GPS jitter and skipped
+MIN_MOVE_METERS = 5.0
+# Vehicles not reported for this long are dropped along with their predictions
+VEHICLE_TTL_SECONDS = 300
+# Number of shape segments ahead of the last match searched before a full scan
+SEARCH_WINDOW = 60
+# A windowed match further than this from the shape triggers a full scan
+REMATCH_DISTANCE_M = 75.0
+
+
+def distance_m(lat1, lon1, lat2, lon2):
+    """
+    Great-circle distance in meters between two points.
+    """
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlmb = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+def seconds_of_day(value):
+    return value.hour * 3600 + value.minute * 60 + value.second
+
+
+class ShapeLine:
+    """
+    Polyline of a shape in a local planar projection, with cumulative distance in meters.
+    """
+
+    def __init__(self, lats, lons, feed_dist=None):
+        lat = np.asarray(lats, dtype=np.float64)
+        lon = np.asarray(lons, dtype=np.float64)
+        # Equirectangular projection around the shape's mean latitude is
+        # accurate to well under a meter at city scale
+        lat0 = float(lat.mean()) if len(lat) else 0.0
+        self.ky = math.radians(1) * EARTH_RADIUS_M
+        self.kx = self.ky * math.cos(math.radians(lat0))
+        self.x = lon * self.kx
+        self.y = lat * self.ky
+        self.cum = np.concatenate(([0.0], np.cumsum(np.hypot(np.diff(self.x), np.diff(self.y)))))
+        # shape_dist_traveled from the feed, in whatever unit the agency uses
+        self.feed_dist = None
+        if feed_dist is not None and len(feed_dist) == len(lat):
+            feed_dist = np.asarray(feed_dist, dtype=np.float64)
+            if not np.isnan(feed_dist).any():
+                self.feed_dist = np.maximum.accumulate(feed_dist)
+
+    def __len__(self):
+        return len(self.x)
+
+    def project(self, lat, lon, start=0, end=None):
+        """
+        Return (distance_along_m, segment_index, offset_m) of the closest point
+        on segments start..end of the line.
+        """
+        last = len(self.x) - 1
+        if last < 1:
+            return 0.0, 0, math.inf
+        end = last if end is None else min(end, last)
+        start = max(0, min(start, end - 1))
+
+        px, py = lon * self.kx, lat * self.ky
+        ax, ay = self.x[start:end], self.y[start:end]
+        dx = self.x[start + 1:end + 1] - ax
+        dy = self.y[start + 1:end + 1] - ay
+        len2 = dx * dx + dy * dy
+        safe_len2 = np.where(len2 > 0, len2, 1.0)
+        t = np.clip(((px - ax) * dx + (py - ay) * dy) / safe_len2, 0.0, 1.0)
+        d2 = (px - (ax + t * dx)) ** 2 + (py - (ay + t * dy)) ** 2
+
+        i = int(np.argmin(d2))
+        along = self.cum[start + i] + t[i] * math.sqrt(len2[i])
+        return float(along), start + i, math.sqrt(float(d2[i]))
+
+    def feed_to_meters(self, values):
+        return np.interp(values, self.feed_dist, self.cum)
+
+
+class TripSchedule:
+    """
+    Static schedule of a trip: stops in order with their distance along the shape.
+    Times are seconds after the service day's midnight and may exceed 24h.
+    """
+
+    __slots__ = ("trip_id", "route_id", "shape_id", "stop_ids", "stop_sequences", "dist", "arrival", "departure")
+
+    def __init__(self, trip_id, route_id, shape_id, stop_ids, stop_sequences, dist, arrival, departure):
+        self.trip_id = trip_id
+        self.route_id = route_id
+        self.shape_id = shape_id
+        self.stop_ids = stop_ids
+        self.stop_sequences = stop_sequences
+        self.dist = dist
+        self.arrival = arrival
+        self.departure = departure
+
+
+class VehicleState:
+    __slots__ = ("vehicle_id", "trip_id", "lat", "lon", "timestamp", "dist", "segment", "delay", "last_seen")
+
+    def __init__(self, vehicle_id, trip_id):
+        self.vehicle_id = vehicle_id
+        self.trip_id = trip_id
+        self.lat = None
+        self.lon = None
+        self.timestamp = None
+        self.dist = None
+        self.segment = 0
+        self.delay = 0.0
+        self.last_seen = 0.0
+
+
+class ETAEngine:
+    """
+    Predicts arrival times at downstream stops from live vehicle positions.
+    Predictions are kept indexed both by trip and by stop.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self.timezone = None
+        self.shapes = {}
+        self.trips = {}
+        self.vehicles = {}
+        self.by_trip = {}
+        self.by_stop = {}
+        self.stats = {"updated": 0, "skipped": 0, "unmatched": 0}
+        self._lock = threading.Lock()
+
+    # ------------------------------------------------------------------
+    # Static data
+    # ------------------------------------------------------------------
+
+    def ensure_loaded(self, db: Session):
+        if not self.loaded:
+            self.load(db)
+
+    def load(self, db: Session):
+        """
+        Build shape lines and trip schedules from the static GTFS tables.
+        Any existing vehicle state and predictions are discarded.
+        """
+        agency = db.query(Agency.agency_timezone).first()
+        timezone = ZoneInfo(agency.agency_timezone) if agency and agency.agency_timezone else None
+
+        shapes = {}
+        for geometry in db.query(ShapeGeometry).all():
+            arrays = ShapeArrays(geometry)
+            shapes[arrays.shape_id] = ShapeLine(arrays.latitudes, arrays.longitudes, arrays.feed_dist_traveled)
+
+        stop_coords = {
+            stop.stop_id: (float(stop.stop_lat), float(stop.stop_lon))
+            for stop in db.query(Stop.stop_id, Stop.stop_lat, Stop.stop_lon).all()
+        }
+        trip_info = {
+            trip.trip_id: trip for trip in db.query(Trip.trip_id, Trip.route_id, Trip.shape_id).all()
+        }
+        stop_time_rows = (
+            db.query(
+                StopTime.trip_id,
+                StopTime.stop_id,
+                StopTime.stop_sequence,
+                StopTime.arrival_time,
+                StopTime.departure_time,
+                StopTime.shape_dist_traveled,
+            )
+            .order_by(StopTime.trip_id, StopTime.stop_sequence)
+            .all()
+        )
+
+        trips = {}
+        for trip_id, rows in groupby(stop_time_rows, key=lambda row: row.trip_id):
+            info = trip_info.get(trip_id)
+            line = shapes.get(info.shape_id) if info else None
+            if line is None or len(line) < 2:
+                continue
+            schedule = self._build_schedule(info, line, list(rows), stop_coords)
+            if schedule is not None:
+                trips[trip_id] = schedule
+
+        with self._lock:
+            self.timezone = timezone
+            self.shapes = shapes
+            self.trips = trips
+            self.vehicles = {}
+            self.by_trip = {}
+            self.by_stop = {}
+            self.loaded = True
+
+    @staticmethod
+    def _build_schedule(info, line, rows, stop_coords):
+        # Unwrap times so they keep increasing across midnight
+        arrival, departure = [], []
+        offset, previous = 0, 0
+        for row in rows:
+            arr = seconds_of_day(row.arrival_time) + offset
+            if arr < previous:
+                offset += 86400
+                arr += 86400
+            dep = seconds_of_day(row.departure_time) + offset
+            if dep < arr:
+                offset += 86400
+                dep += 86400
+            arrival.append(arr)
+            departure.append(dep)
+            previous = dep
+
+        feed_dist = [row.shape_dist_traveled for row in rows]
+        if line.feed_dist is not None and all(d is not None for d in feed_dist):
+            dist = line.feed_to_meters(np.asarray(feed_dist, dtype=np.float64))
+        else:
+            # No usable shape_dist_traveled: snap stops onto the shape in order
+            dist, segment = [], 0
+            for row in rows:
+                coords = stop_coords.get(row.stop_id)
+                if coords is None:
+                    return None
+                along, segment, _ = line.project(coords[0], coords[1], start=segment)
+                dist.append(along)
+            dist = np.asarray(dist, dtype=np.float64)
+
+        return TripSchedule(
+            trip_id=info.trip_id,
+            route_id=info.route_id,
+            shape_id=info.shape_id,
+            stop_ids=[row.stop_id for row in rows],
+            stop_sequences=[row.stop_sequence for row in rows],
+            dist=np.maximum.accumulate(dist),
+            arrival=np.asarray(arrival, dtype=np.float64),
+            departure=np.asarray(departure, dtype=np.float64),
+        )
+
+    # ------------------------------------------------------------------
+    # Live updates
+    # ------------------------------------------------------------------
+
+    def update(self, positions, now=None):
+        """
+        Apply a tick of vehicle positions. Each position is a dict with
+        vehicle_id, trip_id, latitude, longitude and optionally timestamp.
+        Returns the stop arrivals observed since the previous tick as
+        (trip_id, stop_id, arrival_epoch) tuples.
+        """
+        now = time.time() if now is None else now
+        arrivals = []
+        with self._lock:
+            for position in positions:
+                trip = self.trips.get(position.get("trip_id"))
+                if trip is None:
+                    self.stats["unmatched"] += 1
+                    continue
+
+                vehicle_id = position["vehicle_id"]
+                lat, lon = position["latitude"], position["longitude"]
+                timestamp = position.get("timestamp") or now
+                state = self.vehicles.get(vehicle_id)
+
+                if state is not None and state.trip_id == trip.trip_id:
+                    state.last_seen = now
+                    if timestamp <= state.timestamp or distance_m(state.lat, state.lon, lat, lon) < MIN_MOVE_METERS:
+                        self.stats["skipped"] += 1
+                        continue
+                else:
+                    if state is not None:
+                        self._drop(state)
+                    state = VehicleState(vehicle_id, trip.trip_id)
+                    state.last_seen = now
+                    self.vehicles[vehicle_id] = state
+
+                arrivals.extend(self._advance(state, trip, lat, lon, timestamp))
+                self.stats["updated"] += 1
+
+            self._expire(now)
+        return arrivals
+
+    def _advance(self, state, trip, lat, lon, timestamp):
+        line = self.shapes[trip.shape_id]
+        if state.dist is None:
+            along, segment, _ = line.project(lat, lon)
+        else:
+            along, segment, offset = line.project(lat, lon, start=state.segment - 1, end=state.segment + SEARCH_WINDOW)
+            if offset > REMATCH_DISTANCE_M:
+                along, segment, _ = line.project(lat, lon)
+
+        previous_dist, previous_time = state.dist, state.timestamp
+        # Vehicles do not move backwards along a trip; treat regressions as jitter
+        if previous_dist is not None and along < previous_dist:
+            along = previous_dist
+
+        midnight, time_of_day = self._service_clock(timestamp, trip)
+        scheduled = float(np.interp(along, trip.dist, trip.departure))
+        delay = time_of_day - scheduled
+        next_stop = int(np.searchsorted(trip.dist, along, side="right"))
+        if next_stop == 0:
+            # Still before the first stop: an early vehicle waits for its departure
+            delay = max(delay, 0.0)
+
+        arrivals = []
+        if previous_dist is not None and along > previous_dist:
+            passed_from = int(np.searchsorted(trip.dist, previous_dist, side="right"))
+            for k in range(passed_from, next_stop):
+                fraction = float(trip.dist[k] - previous_dist) / (along - previous_dist)
+                arrivals.append((trip.trip_id, trip.stop_ids[k], previous_time + fraction * (timestamp - previous_time)))
+
+        state.lat, state.lon = lat, lon
+        state.timestamp = timestamp
+        state.dist = along
+        state.segment = segment
+        state.delay = delay
+        self._set_predictions(state, trip, next_stop, midnight)
+        return arrivals
+
+    def _service_clock(self, timestamp, trip):
+        """
+        Return (midnight_epoch, seconds_since_midnight) of the service day the
+        trip most plausibly belongs to at this timestamp.
+        """
+        local = datetime.fromtimestamp(timestamp, self.timezone)
+        midnight = local.replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+        time_of_day = timestamp - midnight
+        # A trip scheduled past midnight belongs to the previous service day
+        if time_of_day + 43200 < trip.departure[0]:
+            midnight -= 86400
+            time_of_day += 86400
+        elif time_of_day - 43200 > trip.arrival[-1]:
+            midnight += 86400
+            time_of_day -= 86400
+        return midnight, time_of_day
+
+    def _set_predictions(self, state, trip, next_stop, midnight):
+        self._clear_predictions(trip.trip_id)
+        stops = []
+        for k in range(next_stop, len(trip.stop_ids)):
+            prediction = {
+                "trip_id": trip.trip_id,
+                "route_id": trip.route_id,
+                "vehicle_id": state.vehicle_id,
+                "stop_id": trip.stop_ids[k],
+                "stop_sequence": trip.stop_sequences[k],
+                "scheduled_arrival": int(midnight + trip.arrival[k]),
+                "predicted_arrival": int(midnight + trip.arrival[k] + state.delay),
+                "delay_seconds": int(state.delay),
+            }
+            stops.append(prediction)
+            self.by_stop.setdefault(trip.stop_ids[k], {})[trip.trip_id] = prediction
+        self.by_trip[trip.trip_id] = {
+            "trip_id": trip.trip_id,
+            "route_id": trip.route_id,
+            "vehicle_id": state.vehicle_id,
+            "delay_seconds": int(state.delay),
+            "updated_at": int(state.timestamp),
+            "stops": stops,
+        }
+
+    def _clear_predictions(self, trip_id):
+        previous = self.by_trip.pop(trip_id, None)
+        if previous is None:
+            return
+        for prediction in previous["stops"]:
+            stop_predictions = self.by_stop.get(prediction["stop_id"])
+            if stop_predictions is not None:
+                stop_predictions.pop(trip_id, None)
+                if not stop_predictions:
+                    del self.by_stop[prediction["stop_id"]]
+
+    def _drop(self, state):
+        self._clear_predictions(state.trip_id)
+        self.vehicles.pop(state.vehicle_id, None)
+
+    def _expire(self, now):
+        stale = [state for state in self.vehicles.values() if now - state.last_seen > VEHICLE_TTL_SECONDS]
+        for state in stale:
+            self._drop(state)
+
+    # ------------------------------------------------------------------
+    # Queries
+    # ------------------------------------------------------------------
+
+    # Vehicles are also expired here, since update() does not run while the
+    # positions poller is idle; stops the vehicle should already have passed
+    # are left out.
+
+    def predictions_for_stop(self, stop_id, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            self._expire(now)
+            predictions = [p for p in self.by_stop.get(stop_id, {}).values() if p["predicted_arrival"] >= now]
+        return sorted(predictions, key=lambda p: p["predicted_arrival"])
+
+    def predictions_for_trip(self, trip_id, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            self._expire(now)
+            prediction = self.by_trip.get(trip_id)
+            if prediction is None:
+                return None
+            return {**prediction, "stops": [p for p in prediction["stops"] if p["predicted_arrival"] >= now]}
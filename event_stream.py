@@ -0,0 +1,213 @@
+import asyncio
+import json
+import uuid
+from collections import deque
+
+# Server-Sent Events for record feeds (trip updates and alerts).
+# Every new feed snapshot becomes one event in a bounded in-memory log that
+# holds the entities added, changed or removed since the previous snapshot.
+# Clients get the current state once, then only these changes, filtered by
+# route or stop. Event ids are "<generation>-<sequence>", so a reconnecting
+# client resumes from its Last-Event-ID if that event is still in the log,
+# and is sent the full current state again otherwise (too far behind, or a
+# restarted server).
+# Each record is JSON-encoded once when it changes, and every stream sends
+# those encoded strings. The log is bounded both by event count and by the
+# encoded size of the records its events hold.
+
+# Events kept for Last-Event-ID resume
+EVENT_LOG_SIZE = 500
+# Encoded bytes of old and new records kept across the log
+EVENT_LOG_BYTES = 16 * 1024 * 1024
+# Seconds between keep-alive comments on an idle stream
+KEEP_ALIVE_SECONDS = 15
+
+
+def trip_update_matches(record, route_id=None, stop_id=None):
+    if route_id is not None and record["route_id"] != route_id:
+        return False
+    if stop_id is not None and not any(update["stop_id"] == stop_id for update in record["stop_time_updates"]):
+        return False
+    return True
+
+
+def alert_matches(record, route_id=None, stop_id=None):
+    if route_id is None and stop_id is None:
+        return True
+    for informed in record["informed_entity"]:
+        if (route_id is None or informed["route_id"] == route_id) and (
+            stop_id is None or informed["stop_id"] == stop_id
+        ):
+            return True
+    return False
+
+
+def encode_records(records, entity_ids):
+    return {entity_id: json.dumps(records[entity_id]) for entity_id in entity_ids}
+
+
+class FeedEvent:
+    """
+    Changes between two snapshots: (entity_id, old_record, new_record,
+    encoded_new_record) for each added (old None), changed, or removed
+    (new None) entity. size is the encoded length of the old and new records.
+    """
+
+    __slots__ = ("id", "sequence", "changes", "size")
+
+    def __init__(self, event_id, sequence, changes, size):
+        self.id = event_id
+        self.sequence = sequence
+        self.changes = changes
+        self.size = size
+
+
+class EventLog:
+    """
+    Current records of one feed and the bounded log of changes that led to them.
+    """
+
+    def __init__(self, name, matches, maxlen=EVENT_LOG_SIZE, max_bytes=EVENT_LOG_BYTES):
+        self.name = name
+        self.matches = matches
+        # Unique per process, so workers and restarts never share event ids
+        self.generation = uuid.uuid4().hex
+        self.records = {}
+        # entity_id -> JSON of the current record
+        self.encoded = {}
+        self.events = deque()
+        self.maxlen = maxlen
+        self.max_bytes = max_bytes
+        self.log_bytes = 0
+        self.sequence = 0
+        self.has_snapshot = False
+        self._changed = asyncio.Event()
+
+    @property
+    def last_event_id(self):
+        return f"{self.generation}-{self.sequence}"
+
+    async def on_snapshot(self, snapshot, diff):
+        """
+        FeedPoller listener: record the snapshot's changes as one event.
+        """
+        previous = self.records
+        current = snapshot.records
+        # Encode added and changed records, reuse the JSON of unchanged ones
+        upserted = set(diff.added) | set(diff.changed)
+        stale = [entity_id for entity_id in current if entity_id in upserted or entity_id not in self.encoded]
+        fresh = await asyncio.to_thread(encode_records, current, stale)
+        encoded = {entity_id: fresh.get(entity_id) or self.encoded[entity_id] for entity_id in current}
+
+        changes = [(entity_id, None, current[entity_id], fresh[entity_id]) for entity_id in diff.added]
+        changes += [
+            (entity_id, previous.get(entity_id), current[entity_id], fresh[entity_id]) for entity_id in diff.changed
+        ]
+        changes += [(entity_id, previous[entity_id], None, None) for entity_id in diff.removed if entity_id in previous]
+        size = sum(len(new_json or "") + len(self.encoded.get(entity_id, "")) for entity_id, _, _, new_json in changes)
+
+        self.records = current
+        self.encoded = encoded
+        self.has_snapshot = True
+        if changes or self.sequence == 0:
+            self.sequence += 1
+            self.events.append(FeedEvent(self.last_event_id, self.sequence, changes, size))
+            self.log_bytes += size
+            # Always keep the newest event
+            while len(self.events) > 1 and (len(self.events) > self.maxlen or self.log_bytes > self.max_bytes):
+                self.log_bytes -= self.events.popleft().size
+        # Wake every waiting stream; each one gets a fresh event to wait on
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def events_after(self, event_id):
+        """
+        Events following event_id, or None if it is unknown or no longer in the log.
+        """
+        generation, _, sequence = (event_id or "").rpartition("-")
+        if generation != self.generation or not sequence.isdigit():
+            return None
+        sequence = int(sequence)
+        if sequence > self.sequence:
+            return None
+        if sequence == self.sequence:
+            return []
+        if not self.events or self.events[0].sequence > sequence + 1:
+            return None
+        return [event for event in self.events if event.sequence > sequence]
+
+    async def wait(self, timeout):
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def snapshot_message(self, route_id=None, stop_id=None):
+        records = [
+            self.encoded[entity_id]
+            for entity_id, record in self.records.items()
+            if self.matches(record, route_id, stop_id)
+        ]
+        return format_event(self.last_event_id, "snapshot", f"{{{json.dumps(self.name)}: [{', '.join(records)}]}}")
+
+    def event_message(self, event, route_id=None, stop_id=None):
+        """
+        The event as seen by a client with the given filter, or None if nothing in it concerns that client.
+        An entity that stops matching the filter is reported as removed.
+        """
+        upserted, removed = [], []
+        for entity_id, old, new, encoded in event.changes:
+            if new is not None and self.matches(new, route_id, stop_id):
+                upserted.append(encoded)
+            elif old is not None and self.matches(old, route_id, stop_id):
+                removed.append(entity_id)
+        if not upserted and not removed:
+            return None
+        return format_event(
+            event.id, "update", f'{{"upserted": [{", ".join(upserted)}], "removed": {json.dumps(removed)}}}'
+        )
+
+    async def stream(self, request, last_event_id=None, route_id=None, stop_id=None):
+        """
+        SSE messages for one client until it disconnects.
+        """
+        while not self.has_snapshot:
+            await self.wait(KEEP_ALIVE_SECONDS)
+            if await request.is_disconnected():
+                return
+            if not self.has_snapshot:
+                yield ": keep-alive\n\n"
+
+        sent_sequence = None
+        events = self.events_after(last_event_id)
+        if events is None:
+            yield self.snapshot_message(route_id, stop_id)
+            sent_sequence = self.sequence
+        else:
+            sent_sequence = self.sequence - len(events)
+
+        while True:
+            events = self.events_after(f"{self.generation}-{sent_sequence}")
+            if events is None:
+                # Fell behind the end of the log while sending
+                yield self.snapshot_message(route_id, stop_id)
+                sent_sequence = self.sequence
+                continue
+            for event in events:
+                message = self.event_message(event, route_id, stop_id)
+                if message is not None:
+                    yield message
+                sent_sequence = event.sequence
+            if not events:
+                await self.wait(KEEP_ALIVE_SECONDS)
+                if await request.is_disconnected():
+                    return
+                if sent_sequence == self.sequence:
+                    yield ": keep-alive\n\n"
+
+
+def format_event(event_id, event_type, data):
+    """
+    One SSE message; data is already JSON-encoded.
+    """
+    return f"id: {event_id}\nevent: {event_type}\ndata: {data}\n\n"
@@ -0,0 +1,286 @@
+import asyncio
+import hashlib
+import logging
+import random
+import time
+
+import requests
+
+from feed_snapshot import diff_snapshots
+
+logger = logging.getLogger(__name__)
+
+# Adaptive polling of a GTFS-realtime feed.
+# Instead of a fixed sleep, each poll is scheduled just after the upstream is
+# expected to publish again, based on the cadence observed between
+# FeedMessage.header.timestamp values. Unchanged feeds are not passed on,
+# and are recognised without parsing when the upstream answers a conditional
+# request with 304 or sends the same bytes again; repeated unchanged polls
+# back off, so a frozen upstream is not polled every second. Polling stops
+# while nobody is listening, and upstream errors back off with jitter and
+# eventually open a circuit breaker.
+# Parsing happens in a FeedParser worker, an optional prepare step completes
+# the snapshot (e.g. from the static tables), and listeners receive it
+# together with its diff against the previous one.
+
+# Seconds after the expected publish time at which to poll
+PUBLISH_LAG = 0.5
+# Weight of the newest observed publish interval in the cadence estimate
+CADENCE_SMOOTHING = 0.3
+# Factor applied to the cadence when a poll finds the feed already advanced,
+# so an overestimate is probed downwards instead of confirming itself
+CADENCE_PROBE = 0.8
+REQUEST_TIMEOUT = 10
+
+
+class FeedPoller:
+    """
+    Polls one GTFS-realtime feed and hands every new snapshot to its listeners.
+    """
+
+    def __init__(
+        self,
+        url,
+        name,
+        parse,
+        parser,
+        min_interval=1.0,
+        max_interval=30.0,
+        initial_cadence=2.0,
+        failure_threshold=5,
+        circuit_cooldown=60.0,
+        prepare=None,
+    ):
+        self.url = url
+        self.name = name
+        self.parse = parse
+        self.parser = parser
+        # Called in a thread with each new snapshot before it is diffed; returns the snapshot
+        self.prepare = prepare
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.failure_threshold = failure_threshold
+        self.circuit_cooldown = circuit_cooldown
+
+        self.initial_cadence = initial_cadence
+        self.cadence = initial_cadence
+        # Whether a poll saw the current header timestamp unchanged, which
+        # makes the gap to the next timestamp a single publish interval
+        self.seen_unchanged = False
+        self.latest_snapshot = None
+        self.header_timestamp = 0
+        self.content_digest = None
+        self.etag = None
+        self.last_modified = None
+        self.unchanged_polls = 0
+        self.consecutive_failures = 0
+        self.circuit_open_until = 0.0
+
+        self.listeners = []
+        self.subscribers = 0
+        self.lease_until = 0.0
+        self.stats = {"polls": 0, "new": 0, "unchanged": 0, "errors": 0, "circuit_opened": 0}
+
+        self._wake = asyncio.Event()
+        self._loop = None
+        self._task = None
+
+    # ------------------------------------------------------------------
+    # Subscribers
+    # ------------------------------------------------------------------
+
+    @property
+    def active(self):
+        return self.subscribers > 0 or time.time() < self.lease_until
+
+    def add_listener(self, callback):
+        """
+        Register an async callback receiving each new snapshot and its SnapshotDiff.
+        """
+        self.listeners.append(callback)
+
+    def add_subscriber(self):
+        self.subscribers += 1
+        self._notify()
+
+    def remove_subscriber(self):
+        self.subscribers = max(0, self.subscribers - 1)
+
+    def keep_alive(self, seconds):
+        """
+        Keep polling for a while without a long-lived subscriber, e.g. for REST consumers.
+        """
+        self.lease_until = max(self.lease_until, time.time() + seconds)
+        self._notify()
+
+    def _notify(self):
+        # Also called from sync endpoints running in the threadpool
+        loop = self._loop
+        if loop is None:
+            self._wake.set()
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self._wake.set()
+        elif not loop.is_closed():
+            loop.call_soon_threadsafe(self._wake.set)
+
+    @property
+    def circuit_open(self):
+        return time.time() < self.circuit_open_until
+
+    # ------------------------------------------------------------------
+    # Polling
+    # ------------------------------------------------------------------
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._loop = asyncio.get_running_loop()
+            self._task = asyncio.create_task(self.run())
+        return self._task
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run(self):
+        while True:
+            if not self.active:
+                while not self.active:
+                    self._wake.clear()
+                    await self._wake.wait()
+                self.reset_cadence()
+
+            remaining = self.circuit_open_until - time.time()
+            if remaining > 0:
+                await asyncio.sleep(remaining)
+                self.reset_cadence()
+                continue
+
+            delay = await self.poll_once()
+            await asyncio.sleep(delay)
+
+    def reset_cadence(self):
+        """
+        Forget the timestamp history after a pause, so the pause itself is
+        not mistaken for the publish interval.
+        """
+        self.header_timestamp = 0
+        self.cadence = self.initial_cadence
+        self.seen_unchanged = False
+        self.unchanged_polls = 0
+
+    async def poll_once(self):
+        """
+        Fetch the feed once, notify listeners if it advanced, and return the
+        number of seconds to wait before the next poll.
+        """
+        self.stats["polls"] += 1
+        try:
+            content = await asyncio.to_thread(self._download)
+            if content is None:
+                # 304 Not Modified
+                return self._on_unchanged()
+            digest = hashlib.blake2b(content, digest_size=16).digest()
+            if digest == self.content_digest:
+                return self._on_unchanged()
+            snapshot = await self.parser.parse(self.parse, content)
+        except Exception as e:
+            return self._on_failure(e)
+        self.consecutive_failures = 0
+        self.content_digest = digest
+
+        timestamp = snapshot.header_timestamp
+        if timestamp and timestamp < self.header_timestamp:
+            # A timestamp going backwards (upstream restart or a bogus future
+            # timestamp earlier on) would otherwise block all later data
+            logger.warning(f"{self.name} feed header timestamp went backwards, resetting")
+            self.reset_cadence()
+        # Feeds without a header timestamp are compared by content alone
+        if timestamp and timestamp <= self.header_timestamp:
+            return self._on_unchanged()
+
+        self.stats["new"] += 1
+        self.unchanged_polls = 0
+        if timestamp and self.header_timestamp:
+            observed = timestamp - self.header_timestamp
+            if observed > self.max_interval:
+                # The upstream stalled; the gap says nothing about its cadence
+                estimate = self.cadence
+            elif self.seen_unchanged:
+                estimate = CADENCE_SMOOTHING * observed + (1 - CADENCE_SMOOTHING) * self.cadence
+            else:
+                # Polled late: several publishes may have happened in between
+                estimate = min(observed, self.cadence * CADENCE_PROBE)
+            self.cadence = min(max(estimate, self.min_interval), self.max_interval)
+        self.seen_unchanged = False
+        self.header_timestamp = timestamp or self.header_timestamp
+        if self.prepare is not None:
+            try:
+                snapshot = await asyncio.to_thread(self.prepare, snapshot)
+            except Exception as e:
+                logger.error(f"Error preparing {self.name} feed snapshot: {e}")
+        diff = await asyncio.to_thread(diff_snapshots, self.latest_snapshot, snapshot)
+        self.latest_snapshot = snapshot
+
+        for listener in self.listeners:
+            try:
+                await listener(snapshot, diff)
+            except Exception as e:
+                logger.error(f"Error in {self.name} feed listener: {e}")
+
+        if not timestamp:
+            return self.cadence
+        next_publish = timestamp + self.cadence + PUBLISH_LAG
+        return min(max(next_publish - time.time(), self.min_interval), self.max_interval)
+
+    def _on_unchanged(self):
+        self.stats["unchanged"] += 1
+        self.seen_unchanged = True
+        self.unchanged_polls += 1
+        # Double the wait on each repeat while the upstream is frozen
+        return min(self.min_interval * 2 ** (self.unchanged_polls - 1), self.max_interval)
+
+    def _download(self):
+        """
+        Feed bytes, or None if the upstream reports them unchanged since the last download.
+        """
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        response = requests.get(self.url, headers=headers, timeout=REQUEST_TIMEOUT)
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()
+        self.etag = response.headers.get("ETag")
+        self.last_modified = response.headers.get("Last-Modified")
+        return response.content
+
+    def _on_failure(self, error):
+        self.stats["errors"] += 1
+        self.consecutive_failures += 1
+        # Publishes may be missed while failing
+        self.seen_unchanged = False
+        logger.error(f"Error polling {self.name} feed ({self.consecutive_failures} in a row): {error}")
+
+        if self.consecutive_failures >= self.failure_threshold:
+            # Stay away for a cooldown, then allow a single trial poll
+            self.circuit_open_until = time.time() + self.circuit_cooldown
+            self.consecutive_failures = self.failure_threshold - 1
+            self.stats["circuit_opened"] += 1
+            logger.warning(f"Circuit opened for {self.name} feed for {self.circuit_cooldown:.0f}s")
+            return 0
+
+        # Exponential backoff with full jitter
+        backoff = min(self.max_interval, self.min_interval * 2 ** self.consecutive_failures)
+        return random.uniform(self.min_interval, backoff)
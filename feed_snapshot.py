@@ -0,0 +1,331 @@
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from gtfs_realtime_pb2 import FeedMessage
+
+logger = logging.getLogger(__name__)
+
+# Parsing of GTFS-realtime feeds into compact snapshots, off the event loop.
+# The parse_* functions are plain module-level functions so they can run in a
+# worker process; they return small picklable snapshots instead of protobuf
+# objects. Consecutive snapshots are diffed by entity.id so consumers only
+# process entities that were added, changed or removed.
+
+
+class VehicleSnapshot:
+    """
+    Vehicle positions stored column by column, one row per feed entity.
+    """
+
+    __slots__ = (
+        "header_timestamp",
+        "entity_ids",
+        "vehicle_ids",
+        "trip_ids",
+        "latitude",
+        "longitude",
+        "bearing",
+        "timestamp",
+        "_index",
+    )
+
+    def __init__(self, header_timestamp, entity_ids, vehicle_ids, trip_ids, latitude, longitude, bearing, timestamp):
+        self.header_timestamp = header_timestamp
+        self.entity_ids = entity_ids
+        self.vehicle_ids = vehicle_ids
+        self.trip_ids = trip_ids
+        self.latitude = latitude
+        self.longitude = longitude
+        self.bearing = bearing
+        self.timestamp = timestamp
+        self._index = None
+
+    def __len__(self):
+        return len(self.entity_ids)
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__[:-1])
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__[:-1], state):
+            setattr(self, name, value)
+        self._index = None
+
+    @property
+    def index(self):
+        """
+        Map of entity id to row number, built on first use.
+        """
+        if self._index is None:
+            self._index = {entity_id: row for row, entity_id in enumerate(self.entity_ids)}
+        return self._index
+
+    def row(self, i):
+        return {
+            "entity_id": self.entity_ids[i],
+            "vehicle_id": self.vehicle_ids[i],
+            "trip_id": self.trip_ids[i],
+            "latitude": float(self.latitude[i]),
+            "longitude": float(self.longitude[i]),
+            "bearing": float(self.bearing[i]),
+            "timestamp": int(self.timestamp[i]),
+        }
+
+
+class RecordSnapshot:
+    """
+    Feed entities flattened into JSON-ready records keyed by entity id.
+    """
+
+    __slots__ = ("header_timestamp", "records")
+
+    def __init__(self, header_timestamp, records):
+        self.header_timestamp = header_timestamp
+        self.records = records
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getstate__(self):
+        return self.header_timestamp, self.records
+
+    def __setstate__(self, state):
+        self.header_timestamp, self.records = state
+
+
+class SnapshotDiff:
+    """
+    Entity ids added, changed and removed between two snapshots.
+    """
+
+    __slots__ = ("added", "changed", "removed")
+
+    def __init__(self, added=(), changed=(), removed=()):
+        self.added = list(added)
+        self.changed = list(changed)
+        self.removed = list(removed)
+
+    def __bool__(self):
+        return bool(self.added or self.changed or self.removed)
+
+    @property
+    def upserted(self):
+        return self.added + self.changed
+
+
+def _parse(content):
+    feed = FeedMessage()
+    feed.ParseFromString(content)
+    return feed
+
+
+def parse_vehicle_positions(content):
+    """
+    Parse a vehicle positions feed into a VehicleSnapshot.
+    """
+    feed = _parse(content)
+    header_timestamp = feed.header.timestamp
+    entity_ids, vehicle_ids, trip_ids = [], [], []
+    latitude, longitude, bearing, timestamp = [], [], [], []
+
+    for entity in feed.entity:
+        if not entity.HasField("vehicle"):
+            continue
+        vehicle = entity.vehicle
+        entity_ids.append(entity.id)
+        vehicle_ids.append(vehicle.vehicle.id)
+        trip_ids.append(vehicle.trip.trip_id)
+        latitude.append(vehicle.position.latitude)
+        longitude.append(vehicle.position.longitude)
+        bearing.append(vehicle.position.bearing)
+        timestamp.append(vehicle.timestamp or header_timestamp)
+
+    return VehicleSnapshot(
+        header_timestamp,
+        entity_ids,
+        vehicle_ids,
+        trip_ids,
+        np.asarray(latitude, dtype=np.float64),
+        np.asarray(longitude, dtype=np.float64),
+        np.asarray(bearing, dtype=np.float32),
+        np.asarray(timestamp, dtype=np.int64),
+    )
+
+
+def parse_trip_updates(content):
+    """
+    Parse a trip updates feed into a RecordSnapshot.
+    """
+    feed = _parse(content)
+    records = {
+        entity.id: {
+            "entity_id": entity.id,
+            "trip_id": entity.trip_update.trip.trip_id,
+            "route_id": entity.trip_update.trip.route_id,
+            "start_time": entity.trip_update.trip.start_time,
+            "start_date": entity.trip_update.trip.start_date,
+            "stop_time_updates": [
+                {
+                    "stop_id": update.stop_id,
+                    "arrival": update.arrival.time if update.HasField("arrival") else None,
+                    "departure": update.departure.time if update.HasField("departure") else None,
+                }
+                for update in entity.trip_update.stop_time_update
+            ],
+        }
+        for entity in feed.entity
+        if entity.HasField("trip_update")
+    }
+    return RecordSnapshot(feed.header.timestamp, records)
+
+
+def parse_alerts(content):
+    """
+    Parse a service alerts feed into a RecordSnapshot.
+    """
+    feed = _parse(content)
+    records = {
+        entity.id: {
+            "entity_id": entity.id,
+            "alert_id": entity.id,
+            "cause": entity.alert.cause,
+            "effect": entity.alert.effect,
+            "header_text": entity.alert.header_text.translation[0].text
+            if entity.alert.header_text.translation
+            else None,
+            "description_text": entity.alert.description_text.translation[0].text
+            if entity.alert.description_text.translation
+            else None,
+            "informed_entity": [
+                {
+                    "agency_id": informed.agency_id,
+                    "route_id": informed.route_id,
+                    "stop_id": informed.stop_id,
+                }
+                for informed in entity.alert.informed_entity
+            ],
+        }
+        for entity in feed.entity
+        if entity.HasField("alert")
+    }
+    return RecordSnapshot(feed.header.timestamp, records)
+
+
+def diff_snapshots(previous, current):
+    """
+    Compare two snapshots of the same feed by entity id.
+    Everything in current counts as added when there is no previous snapshot.
+    """
+    if isinstance(current, VehicleSnapshot):
+        return _diff_vehicles(previous, current)
+    return _diff_records(previous, current)
+
+
+def _diff_vehicles(previous, current):
+    if previous is None or len(previous) == 0:
+        return SnapshotDiff(added=current.entity_ids)
+
+    previous_index = previous.index
+    rows = np.fromiter(
+        (previous_index.get(entity_id, -1) for entity_id in current.entity_ids),
+        dtype=np.int64,
+        count=len(current),
+    )
+    known = rows >= 0
+    matched = np.where(known, rows, 0)
+    moved = (
+        (current.latitude != previous.latitude[matched])
+        | (current.longitude != previous.longitude[matched])
+        | (current.bearing != previous.bearing[matched])
+        | (current.timestamp != previous.timestamp[matched])
+    )
+    # Trip changes are rare; only compare them for vehicles that otherwise look the same
+    for i in np.flatnonzero(known & ~moved):
+        if current.trip_ids[i] != previous.trip_ids[rows[i]]:
+            moved[i] = True
+
+    entity_ids = current.entity_ids
+    added = [entity_ids[i] for i in np.flatnonzero(~known)]
+    changed = [entity_ids[i] for i in np.flatnonzero(known & moved)]
+    current_index = current.index
+    removed = [entity_id for entity_id in previous.entity_ids if entity_id not in current_index]
+    return SnapshotDiff(added, changed, removed)
+
+
+def _diff_records(previous, current):
+    previous_records = previous.records if previous is not None else {}
+    added, changed = [], []
+    for entity_id, record in current.records.items():
+        old = previous_records.get(entity_id)
+        if old is None:
+            added.append(entity_id)
+        elif old != record:
+            changed.append(entity_id)
+    removed = [entity_id for entity_id in previous_records if entity_id not in current.records]
+    return SnapshotDiff(added, changed, removed)
+
+
+class FeedParser:
+    """
+    Runs feed parse functions in a worker pool so protobuf decoding never
+    blocks the event loop. A process pool also sidesteps the GIL; a thread
+    pool avoids pickling the snapshot back and is enough for small feeds.
+    A process pool whose worker died is replaced by a fresh one.
+    """
+
+    def __init__(self, use_processes=True, max_workers=1):
+        self.use_processes = use_processes
+        self.max_workers = max_workers
+        self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.use_processes:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="feed-parser")
+        return self._executor
+
+    def warm_up(self):
+        """
+        Start the workers ahead of the first feed, so process spawn and
+        imports are not paid on the first poll.
+        """
+        executor = self._get_executor()
+        try:
+            for future in [executor.submit(int, 0) for _ in range(self.max_workers)]:
+                future.result()
+        except BrokenProcessPool:
+            # Let a retry start from a fresh pool
+            self._discard(executor)
+            raise
+
+    async def parse(self, parse_function, content):
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+        try:
+            return await loop.run_in_executor(executor, parse_function, content)
+        except BrokenProcessPool:
+            # A worker died (out of memory, crash on a bad feed); retry once in a fresh pool
+            logger.warning("Feed parser worker died, restarting the worker pool")
+            self._discard(executor)
+            return await loop.run_in_executor(self._get_executor(), parse_function, content)
+
+    def _discard(self, executor):
+        # Concurrent parses may all see the same broken pool; replace it only once
+        if self._executor is executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,139 @@
+from datetime import date
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import select
+
+from models import Calendar, StopTime, Trip
+
+# Headway and service-frequency analytics computed from the static timetable.
+# Everything is vectorized over the full stop_times table: departures are
+# expanded to every weekday their service runs on, sorted once, and headways
+# are taken as differences between consecutive departures of the same route
+# (per direction) or at the same stop.
+
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+
+
+def load_departures(connection, reference_date=None):
+    """
+    Read every scheduled departure of services active on reference_date
+    (today by default), one row per (trip, stop, service day).
+    """
+    reference_date = reference_date or date.today()
+    calendar = pd.read_sql(
+        select(Calendar.service_id, *[getattr(Calendar, day) for day in WEEKDAYS]).where(
+            Calendar.start_date <= reference_date,
+            Calendar.end_date >= reference_date,
+        ),
+        connection,
+    )
+    departures = pd.read_sql(
+        select(
+            Trip.route_id,
+            Trip.direction_id,
+            Trip.service_id,
+            Trip.trip_id,
+            StopTime.stop_id,
+            StopTime.stop_sequence,
+            StopTime.departure_time,
+        )
+        .select_from(StopTime)
+        .join(Trip, Trip.trip_id == StopTime.trip_id),
+        connection,
+    )
+    return expand_service_days(departures, calendar)
+
+
+def expand_service_days(departures, calendar):
+    """
+    Attach the weekdays each departure's service runs on and convert
+    departure times to seconds after midnight.
+    """
+    days = calendar.melt(id_vars="service_id", value_vars=WEEKDAYS, var_name="service_day", value_name="runs")
+    days = days.loc[days["runs"].astype(bool), ["service_id", "service_day"]]
+    departures = departures.merge(days, on="service_id", how="inner")
+    departures["departure_seconds"] = to_seconds(departures["departure_time"])
+    departures["service_day"] = pd.Categorical(departures["service_day"], categories=WEEKDAYS)
+    return departures.drop(columns=["departure_time", "service_id"])
+
+
+def to_seconds(times):
+    """
+    Convert time values or HH:MM:SS strings to integer seconds after midnight.
+    """
+    parts = times.astype(str).str.split(":", expand=True).astype(np.int64)
+    return (parts[0] * 3600 + parts[1] * 60 + parts[2]).astype(np.int32)
+
+
+def format_seconds(seconds):
+    seconds = seconds.astype(np.int64)
+    return (
+        (seconds // 3600).map("{:02d}".format)
+        + ":"
+        + (seconds % 3600 // 60).map("{:02d}".format)
+        + ":"
+        + (seconds % 60).map("{:02d}".format)
+    )
+
+
+def _frequency_tables(departures, keys):
+    """
+    Hourly counts/headways and daily span for departures grouped by keys + service_day.
+    """
+    group_keys = keys + ["service_day"]
+    departures = departures.sort_values(group_keys + ["departure_seconds"])
+    # Headway in minutes to the previous departure in the same group
+    departures["headway_min"] = (
+        departures.groupby(group_keys, observed=True, dropna=False)["departure_seconds"].diff() / 60.0
+    )
+    departures["hour"] = (departures["departure_seconds"] // 3600).astype(np.int16)
+
+    hourly = (
+        departures.groupby(group_keys + ["hour"], observed=True, dropna=False)
+        .agg(
+            trip_count=("departure_seconds", "size"),
+            mean_headway_min=("headway_min", "mean"),
+            min_headway_min=("headway_min", "min"),
+            max_headway_min=("headway_min", "max"),
+        )
+        .reset_index()
+    )
+
+    span = (
+        departures.groupby(group_keys, observed=True, dropna=False)
+        .agg(
+            first_departure=("departure_seconds", "min"),
+            last_departure=("departure_seconds", "max"),
+            trip_count=("departure_seconds", "size"),
+            mean_headway_min=("headway_min", "mean"),
+        )
+        .reset_index()
+    )
+    span["first_departure"] = format_seconds(span["first_departure"])
+    span["last_departure"] = format_seconds(span["last_departure"])
+
+    for table in (hourly, span):
+        table["service_day"] = table["service_day"].astype(str)
+        for column in ("mean_headway_min", "min_headway_min", "max_headway_min"):
+            if column in table:
+                table[column] = table[column].round(1)
+    return hourly, span
+
+
+def compute_frequency(departures):
+    """
+    Build the route and stop frequency tables from expanded departures.
+    Routes are measured at the first stop of each trip, per direction.
+    Returns (route_hourly, route_span, stop_hourly, stop_span).
+    """
+    first_stops = departures.sort_values("stop_sequence").drop_duplicates(["trip_id", "service_day"])
+    route_hourly, route_span = _frequency_tables(
+        first_stops[["route_id", "direction_id", "service_day", "departure_seconds"]].copy(),
+        ["route_id", "direction_id"],
+    )
+    stop_hourly, stop_span = _frequency_tables(
+        departures[["stop_id", "service_day", "departure_seconds"]].copy(),
+        ["stop_id"],
+    )
+    return route_hourly, route_span, stop_hourly, stop_span
@@ -0,0 +1,41 @@
+from sqlalchemy.orm import Session
+from models import RouteFrequency, RouteServiceSpan, StopFrequency, StopServiceSpan
+from database import engine
+from create_tables import create_tables
+from frequency_analytics import compute_frequency, load_departures
+
+# Precomputes headway and frequency tables from the loaded timetable.
+# Run after the stop_times, trips and calendar load scripts.
+
+def load_frequency_data():
+  try:
+    # Read departures of active services and compute the frequency tables
+    with engine.connect() as connection:
+      departures = load_departures(connection)
+    route_hourly, route_span, stop_hourly, stop_span = compute_frequency(departures)
+
+    tables = [
+      (RouteFrequency, route_hourly),
+      (RouteServiceSpan, route_span),
+      (StopFrequency, stop_hourly),
+      (StopServiceSpan, stop_span),
+    ]
+
+    # Replace the previous results in a single transaction
+    with Session(engine) as session:
+      for model, df in tables:
+        session.query(model).delete()
+        df = df.astype(object).where(df.notna(), None)
+        session.bulk_insert_mappings(model, df.to_dict(orient="records"))
+
+      # Commit the session to save the data to the database
+      session.commit()
+
+    print("Frequency data loaded successfully.")
+
+  except Exception as e:
+    print(f"An error occurred: {e}")
+
+if __name__ == "__main__":
+  create_tables()
+  load_frequency_data()
@@ -1,40 +1,57 @@
+import argparse
 import pandas as pd
 from sqlalchemy.orm import Session
-from models import Shape
+from models import Shape, ShapeGeometry
 from database import engine
 from create_tables import create_tables
 from envConfig import GTFS_ROOT_FILE_PATH
+from shape_geometry import pack_shape
 
 # Reference: https://dnmtechs.com/loading-csv-file-into-database-using-sqlalchemy-in-python-3/
 # Regerence: https://iifx.dev/en/articles/167606266
 # Used this for all the load scripts
 
-def load_shapes_data():
+# Shapes are stored packed, one shape_geometry row per shape.
+# Pass --points to also export the one-row-per-point shapes table.
+
+def load_shapes_data(include_points=False):
   try:
     # Read shapes.txt into a pandas DataFrame
-    df = pd.read_csv(GTFS_ROOT_FILE_PATH + '/shapes.txt')
+    df = pd.read_csv(GTFS_ROOT_FILE_PATH + '/shapes.txt', dtype={'shape_id': str})
+    if 'shape_dist_traveled' not in df:
+      df['shape_dist_traveled'] = None
+
+    geometries = [pack_shape(shape_id, points) for shape_id, points in df.groupby('shape_id', sort=False)]
 
     # Create a new session
     with Session(engine) as session:
-      for _, row in df.iterrows():
-        shape = Shape(
-          shape_id=row['shape_id'],
-          shape_pt_lat=row['shape_pt_lat'],
-          shape_pt_lon=row['shape_pt_lon'],
-          shape_pt_sequence=row['shape_pt_sequence'],
-          shape_dist_traveled=row['shape_dist_traveled'] if pd.notna(row['shape_dist_traveled']) else None,
-          eta_pattern_id=row['eta_pattern_id'] if pd.notna(row['eta_pattern_id']) else None
-        )
-        session.add(shape)
+      session.query(ShapeGeometry).delete()
+      session.bulk_insert_mappings(ShapeGeometry, geometries)
+
+      if include_points:
+        session.query(Shape).delete()
+        points = pd.DataFrame({
+          'shape_id': df['shape_id'],
+          'shape_pt_lat': df['shape_pt_lat'].astype(str),
+          'shape_pt_lon': df['shape_pt_lon'].astype(str),
+          'shape_pt_sequence': df['shape_pt_sequence'],
+          'shape_dist_traveled': df['shape_dist_traveled'],
+          'eta_pattern_id': df['eta_pattern_id'] if 'eta_pattern_id' in df else None,
+        })
+        points = points.astype(object).where(points.notna(), None)
+        session.bulk_insert_mappings(Shape, points.to_dict(orient='records'))
 
       # Commit the session to save the data to the database
       session.commit()
 
-    print("Shapes data loaded successfully.")
+    print(f"Shapes data loaded successfully ({len(geometries)} shapes, {len(df)} points).")
 
   except Exception as e:
     print(f"An error occurred: {e}")
 
 if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Load shapes.txt")
+  parser.add_argument("--points", action="store_true", help="also export one row per shape point")
+  args = parser.parse_args()
   create_tables()
-  load_shapes_data()
+  load_shapes_data(include_points=args.points)
@@ -12,7 +12,7 @@ from envConfig import GTFS_ROOT_FILE_PATH
 def load_trips_data():
   try:
     # Read trips.txt into a pandas DataFrame
-    df = pd.read_csv(GTFS_ROOT_FILE_PATH + '/trips.txt')
+    df = pd.read_csv(GTFS_ROOT_FILE_PATH + '/trips.txt', dtype={'shape_id': str})
 
     # Create a new session
     with Session(engine) as session:
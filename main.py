@@ -1,9 +1,39 @@
 import logging
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends, HTTPException
-from sqlalchemy.orm import Session
+import math
+import random
+import threading
+import time
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends, HTTPException, Header, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from sqlalchemy import text
+from sqlalchemy.orm import Session, configure_mappers
 from database import engine, SessionLocal
-from models import Base, Route, Stop, Shape, Trip, StopTime, Calendar
-from gtfs_realtime_pb2 import FeedMessage  # For parsing GTFS-realtime data
+from models import (
+    Base,
+    Route,
+    Stop,
+    ShapeGeometry,
+    Trip,
+    StopTime,
+    Calendar,
+    RouteFrequency,
+    RouteServiceSpan,
+    StopFrequency,
+    StopServiceSpan,
+)
+from eta_engine import ETAEngine
+from feed_poller import FeedPoller
+from feed_snapshot import FeedParser, parse_alerts, parse_trip_updates, parse_vehicle_positions
+from trip_planner import TripPlanner, format_seconds, parse_time_of_day
+from subscriptions import Subscription, SubscriptionError, SubscriptionIndex
+from shared_snapshot import SharedGeneration, SharedSnapshot, default_directory
+from shared_feed import SharedRecordFeed
+from client_sender import ClientSender
+from shape_geometry import ShapeArrays
+from event_stream import EventLog, alert_matches, trip_update_matches
+from request_profiler import ProfiledRoute, ProfilingMiddleware, RequestProfiler
+from collections import Counter
 import requests
 import json
 import asyncio
@@ -12,16 +42,115 @@ from envConfig import (
     GTFS_REAL_TIME_POSITION_UPDATES_URL,
     GTFS_REAL_TIME_TRIP_UPDATES_URL,
     GTFS_REAL_TIME_ALERTS_URL,
+    SHARED_SNAPSHOT_DIR,
+    PROFILE_SAMPLE_RATE,
+    PROFILE_ADMIN_TOKEN,
 )
 import traceback
 from datetime import date
+from typing import Optional
 
 # Set up logging for debugging and tracking application behavior
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Readiness of this worker; set once every startup phase has finished
+startup_state = {"ready": False, "phases": {}}
+# Attempts per startup phase, e.g. when several workers race on create_all
+STARTUP_ATTEMPTS = 3
+
+# Run one blocking startup phase in a thread and record how long it took
+async def run_startup_phase(name, function):
+    started = time.perf_counter()
+    for attempt in range(1, STARTUP_ATTEMPTS + 1):
+        try:
+            await asyncio.to_thread(function)
+            break
+        except Exception as e:
+            startup_state["phases"][name] = {
+                "seconds": round(time.perf_counter() - started, 3),
+                "attempts": attempt,
+                "error": str(e),
+            }
+            logger.error(f"Startup phase {name} failed (attempt {attempt} of {STARTUP_ATTEMPTS}): {e}")
+            if attempt == STARTUP_ATTEMPTS:
+                raise
+            # Jittered backoff so racing workers do not retry in lockstep
+            await asyncio.sleep(random.uniform(0.5, 1.5) * attempt)
+    elapsed = time.perf_counter() - started
+    startup_state["phases"][name] = {"seconds": round(elapsed, 3), "attempts": attempt}
+    logger.info(f"Startup phase {name} finished in {elapsed * 1000:.0f} ms")
+
+def check_schema():
+    # Create database tables from models, then resolve ORM mappers and open a pooled connection
+    Base.metadata.create_all(bind=engine)
+    configure_mappers()
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+
+def warm_eta_engine():
+    with SessionLocal() as db:
+        eta_engine.load(db)
+
+def warm_trip_planner():
+    with SessionLocal() as db:
+        trip_planner.timetable_for(db, trip_planner.local_now(db).date())
+
+# Lifespan handler: warm everything up before reporting ready, clean up on shutdown
+# Reference: https://fastapi.tiangolo.com/advanced/events/
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    started = time.perf_counter()
+    try:
+        await run_startup_phase("schema", check_schema)
+        # Only one worker polls upstream; the others follow its shared snapshot
+        is_leader = shared_positions.try_acquire_leadership()
+        phases = [
+            run_startup_phase("eta_engine", warm_eta_engine),
+            run_startup_phase("trip_planner", warm_trip_planner),
+        ]
+        if is_leader:
+            phases.append(run_startup_phase("feed_parser", feed_parser.warm_up))
+        # Independent indexes and caches are built in parallel
+        await asyncio.gather(*phases)
+        if is_leader:
+            positions_poller.start()
+        # Idle until an SSE or REST client needs them
+        for feed in shared_record_feeds:
+            feed.start()
+        background_tasks.append(asyncio.create_task(follow_shared_positions()))
+        logger.info(f"Worker started as {'feed poller' if is_leader else 'snapshot follower'}")
+        startup_state["ready"] = True
+        logger.info(f"Startup finished in {(time.perf_counter() - started) * 1000:.0f} ms, ready for traffic")
+    except Exception:
+        # Exit so the process supervisor restarts the worker instead of leaving it never ready
+        logger.error("Startup warm-up failed after retries, shutting down")
+        logger.debug(traceback.format_exc())
+        feed_parser.shutdown()
+        # Let another worker take over polling
+        shared_positions.close()
+        for feed in shared_record_feeds:
+            feed.channel.close()
+        raise
+
+    yield
+
+    # Close WebSocket connections gracefully
+    startup_state["ready"] = False
+    for task in background_tasks:
+        task.cancel()
+    await positions_poller.stop()
+    await trip_updates_poller.stop()
+    await alerts_poller.stop()
+    feed_parser.shutdown()
+    shared_positions.close()
+    for feed in shared_record_feeds:
+        feed.channel.close()
+    for sender in list(client_senders.values()):
+        await sender.close()
+
 # Initialize FastAPI application
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Configure CORS (Cross-Origin Resource Sharing) to allow all origins
 origins = ["*"]
@@ -34,8 +163,12 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Create database tables from models
-Base.metadata.create_all(bind=engine)
+# Opt-in request profiling; nothing is installed unless a sample rate or admin token is configured
+profiler = RequestProfiler(engine, sample_rate=PROFILE_SAMPLE_RATE, admin_token=PROFILE_ADMIN_TOKEN)
+if profiler.enabled:
+    app.add_middleware(ProfilingMiddleware, profiler=profiler)
+    # Endpoints declared below also record a Python profile for profiled requests
+    app.router.route_class = ProfiledRoute
 
 # Dependency for managing database sessions
 # Ensures each request uses a clean session
@@ -48,12 +181,98 @@ def get_db():
 
 # Track active WebSocket clients
 connected_clients = set()
+# Outgoing queue of each client, and send counters summed over all clients
+client_senders = {}
+websocket_send_totals = Counter()
+
+# Route and area subscriptions of WebSocket clients, and the last view sent to each
+subscription_index = SubscriptionIndex()
+last_sent_views = {}
+latest_bus_positions = []
+
+# Enriched bus positions keyed by feed entity id, updated from snapshot diffs,
+# and their JSON encoding for the shared snapshot
+bus_positions_by_entity = {}
+encoded_positions_by_entity = {}
+# Route details per trip id (None for trips missing from the static tables)
+trip_routes = {}
+# Guards the two tables above, which are updated off the event loop
+positions_lock = threading.Lock()
+
+# RAPTOR journey planner over today's timetable
+trip_planner = TripPlanner()
+
+# Worker pool parsing GTFS-realtime feeds off the event loop
+feed_parser = FeedParser()
 
-# Root endpoint to verify server status
+# Adaptive poller for vehicle positions, paused while nobody is subscribed
+positions_poller = FeedPoller(
+    GTFS_REAL_TIME_POSITION_UPDATES_URL,
+    name="vehicle_positions",
+    parse=parse_vehicle_positions,
+    parser=feed_parser,
+)
+
+# How long ETA queries keep the positions poller running without WebSocket clients
+ETA_KEEP_ALIVE_SECONDS = 600
+
+# Snapshots older than this (seconds) are never served from shared memory
+SHARED_MAX_AGE = 120
+# Vehicle positions shared between uvicorn workers, so only one of them polls upstream
+shared_positions = SharedSnapshot(SHARED_SNAPSHOT_DIR or default_directory(), "vehicle_positions", max_age=SHARED_MAX_AGE)
+# How often followers check for a new shared snapshot, and how long their demand keeps the poller running
+SHARED_READ_INTERVAL = 0.25
+SHARED_DEMAND_TTL = 5
+# Changed by the worker that reloads the static feed, so the others reload too
+static_feed_generation = SharedGeneration(SHARED_SNAPSHOT_DIR or default_directory(), "static_feed")
+# How long a REST request keeps a shared feed polled
+REST_KEEP_ALIVE_SECONDS = 120
+background_tasks = []
+
+# Pollers and change logs behind the trip updates and alerts SSE streams
+trip_updates_poller = FeedPoller(
+    GTFS_REAL_TIME_TRIP_UPDATES_URL,
+    name="trip_updates",
+    parse=parse_trip_updates,
+    parser=feed_parser,
+)
+# Trip updates and alerts are polled by one worker and shared like vehicle positions
+shared_trip_updates = SharedRecordFeed(
+    trip_updates_poller,
+    SharedSnapshot(SHARED_SNAPSHOT_DIR or default_directory(), "trip_updates", max_age=SHARED_MAX_AGE),
+)
+trip_updates_log = EventLog("trips", trip_update_matches)
+shared_trip_updates.add_listener(trip_updates_log.on_snapshot)
+
+alerts_poller = FeedPoller(
+    GTFS_REAL_TIME_ALERTS_URL,
+    name="alerts",
+    parse=parse_alerts,
+    parser=feed_parser,
+)
+shared_alerts = SharedRecordFeed(
+    alerts_poller,
+    SharedSnapshot(SHARED_SNAPSHOT_DIR or default_directory(), "alerts", max_age=SHARED_MAX_AGE),
+)
+alerts_log = EventLog("alerts", alert_matches)
+shared_alerts.add_listener(alerts_log.on_snapshot)
+shared_record_feeds = [shared_trip_updates, shared_alerts]
+
+# In-process ETA predictions, updated from every vehicle positions tick
+eta_engine = ETAEngine()
+
+# Root endpoint to verify server status (liveness)
 @app.get("/")
 async def root():
     return {"message": "Hello World"}
 
+# Readiness endpoint: only succeeds once startup warm-up has completed
+@app.get("/ready")
+async def ready():
+    if not startup_state["ready"]:
+        return JSONResponse(status_code=503, content={"status": "starting", "phases": startup_state["phases"]})
+    return {"status": "ready", "phases": startup_state["phases"]}
+
 # Endpoint to retrieve all routes
 @app.get("/routes")
 def get_routes(db: Session = Depends(get_db)):
@@ -118,18 +337,11 @@ def get_all_routes_details(db: Session = Depends(get_db)):
 
             # Collect shape details for each trip
             unique_shape_ids = list({trip.shape_id for trip in trips if trip.shape_id})
+            # One packed row per shape instead of one row per point
             all_shapes = [
-                {
-                    "latitude": shape.shape_pt_lat,
-                    "longitude": shape.shape_pt_lon,
-                    "sequence": shape.shape_pt_sequence,
-                    "shape_id": shape.shape_id,
-                }
-                for shape_id in unique_shape_ids
-                for shape in db.query(Shape)
-                .filter(Shape.shape_id == shape_id)
-                .order_by(Shape.shape_pt_sequence)
-                .all()
+                point
+                for geometry in db.query(ShapeGeometry).filter(ShapeGeometry.shape_id.in_(unique_shape_ids))
+                for point in ShapeArrays(geometry).points()
             ]
 
             # Collect stop details for each trip
@@ -170,155 +382,380 @@ def get_all_routes_details(db: Session = Depends(get_db)):
 # Function to load GTFS-realtime protocol buffer data from a URL
 # Reference: Parsing GTFS-realtime data using Python Protobuf
 # URL: https://github.com/MobilityData/gtfs-realtime-bindings/blob/master/python/README.md
-async def load_pb_from_url(url):
+async def load_feed_snapshot(url, parse):
     """
-    Load GTFS-realtime data from the specified URL.
+    Load GTFS-realtime data from the specified URL and parse it off the event loop.
     """
     try:
-        response = requests.get(url)
+        # Run the blocking download off the event loop
+        response = await asyncio.to_thread(requests.get, url, timeout=10)
         response.raise_for_status()
-        feed = FeedMessage()
-        feed.ParseFromString(response.content)
-        return feed
+        return await feed_parser.parse(parse, response.content)
     except Exception as e:
         logger.error(f"Error loading data from URL {url}: {e}")
         logger.debug(traceback.format_exc())
         return None
 
-# Function to fetch and process bus positions
+# Fetch route details for trips not seen before, in one query; callers hold positions_lock
+def lookup_trip_routes(trip_ids, db: Session):
+    missing_trips = set(trip_ids) - trip_routes.keys()
+    if not missing_trips:
+        return
+    for trip_id in missing_trips:
+        trip_routes[trip_id] = None
+    matches = (
+        db.query(Trip.trip_id, Route.route_id, Route.route_short_name, Route.route_color)
+        .join(Route, Route.route_id == Trip.route_id)
+        .filter(Trip.trip_id.in_(missing_trips))
+        .all()
+    )
+    for trip_id, route_id, route_short_name, route_color in matches:
+        trip_routes[trip_id] = {
+            "route_id": route_id,
+            "route_short_name": route_short_name,
+            "route_color": route_color,
+        }
+
+# Fill in the route of trip updates whose feed leaves route_id blank, from the static trips table
+def resolve_trip_update_routes(snapshot):
+    blank = [record for record in snapshot.records.values() if not record["route_id"] and record["trip_id"]]
+    if not blank:
+        return snapshot
+    with SessionLocal() as db, positions_lock:
+        lookup_trip_routes({record["trip_id"] for record in blank}, db)
+        for record in blank:
+            route = trip_routes.get(record["trip_id"])
+            if route is not None:
+                record["route_id"] = route["route_id"]
+    return snapshot
+
+# Resolved before diffing, so filled-in routes do not show up as changes
+trip_updates_poller.prepare = resolve_trip_update_routes
+
+# Function to extract and process bus positions
 # Reference: Parsing vehicle position updates in GTFS-realtime
 # URL: https://github.com/MobilityData/gtfs-realtime-bindings/blob/master/python/README.md
-async def fetch_bus_positions(db: Session):
+def update_bus_positions(snapshot, diff, db: Session):
     """
-    Fetch real-time bus positions from GTFS-realtime feed and associate them with routes.
+    Apply a vehicle positions snapshot diff to the enriched bus positions,
+    associating new vehicles with their routes. Returns the positions that
+    were added or changed.
     """
     try:
-        url = GTFS_REAL_TIME_POSITION_UPDATES_URL
-        feed = await load_pb_from_url(url)
-        positions = []
-
-        if not feed:
-            return {"positions": []}
-
-        for entity in feed.entity:
-            if entity.HasField("vehicle"):
-                vehicle_id = entity.vehicle.vehicle.id
-                trip_id = entity.vehicle.trip.trip_id
-                latitude = entity.vehicle.position.latitude
-                longitude = entity.vehicle.position.longitude
-                bearing = entity.vehicle.position.bearing
-
-                # Fetch route details for the trip
-                trip = db.query(Trip).filter(Trip.trip_id == trip_id).first()
-                if trip:
-                    route = db.query(Route).filter(Route.route_id == trip.route_id).first()
-                    if route:
-                        positions.append(
-                            {
-                                "vehicle_id": vehicle_id,
-                                "latitude": latitude,
-                                "longitude": longitude,
-                                "bearing": bearing,
-                                "route_id": route.route_id,
-                                "route_short_name": route.route_short_name,
-                                "route_color": route.route_color,
-                            }
-                        )
-        return {"positions": positions}
+        for entity_id in diff.removed:
+            bus_positions_by_entity.pop(entity_id, None)
+            encoded_positions_by_entity.pop(entity_id, None)
+
+        upserted = diff.upserted
+        rows = [snapshot.index[entity_id] for entity_id in upserted]
+
+        lookup_trip_routes({snapshot.trip_ids[row] for row in rows}, db)
+
+        changed = []
+        for entity_id, row in zip(upserted, rows):
+            route = trip_routes.get(snapshot.trip_ids[row])
+            if route is None:
+                bus_positions_by_entity.pop(entity_id, None)
+                encoded_positions_by_entity.pop(entity_id, None)
+                continue
+            position = {
+                "vehicle_id": snapshot.vehicle_ids[row],
+                "trip_id": snapshot.trip_ids[row],
+                "timestamp": int(snapshot.timestamp[row]),
+                "latitude": float(snapshot.latitude[row]),
+                "longitude": float(snapshot.longitude[row]),
+                "bearing": float(snapshot.bearing[row]),
+                **route,
+            }
+            bus_positions_by_entity[entity_id] = position
+            # Encoded one vehicle at a time, so no single call holds the GIL for the whole fleet
+            encoded_positions_by_entity[entity_id] = json.dumps(position).encode()
+            changed.append(position)
+        return changed
     except Exception as e:
-        logger.error(f"Error fetching real-time positions: {e}")
-        return {"positions": []}
+        logger.error(f"Error processing real-time positions: {e}")
+        return []
+
+# Predicted arrivals at a stop, soonest first
+@app.get("/eta/stops/{stop_id}")
+def get_stop_eta(stop_id: str, db: Session = Depends(get_db)):
+    """
+    Fetch predicted arrivals at a stop from vehicles currently on their trips.
+    """
+    positions_poller.keep_alive(ETA_KEEP_ALIVE_SECONDS)
+    eta_engine.ensure_loaded(db)
+    return {"stop_id": stop_id, "predictions": eta_engine.predictions_for_stop(stop_id)}
+
+# Predicted arrivals at the remaining stops of a trip
+@app.get("/eta/trips/{trip_id}")
+def get_trip_eta(trip_id: str, db: Session = Depends(get_db)):
+    """
+    Fetch the current delay and predicted arrivals for the downstream stops of a trip.
+    """
+    positions_poller.keep_alive(ETA_KEEP_ALIVE_SECONDS)
+    eta_engine.ensure_loaded(db)
+    prediction = eta_engine.predictions_for_trip(trip_id)
+    if prediction is None:
+        raise HTTPException(status_code=404, detail="No live prediction for this trip")
+    return prediction
+
+# Round positions to 6 decimal places to avoid resending minor floating-point differences
+def client_view(vehicles):
+    return {
+        bus["vehicle_id"]: (round(bus["latitude"], 6), round(bus["longitude"], 6))
+        for bus in vehicles
+    }
+
+# Listener called by the positions poller whenever the upstream feed advances
+async def publish_bus_positions(snapshot, diff):
+    """
+    Enrich the changed vehicles, publish the snapshot to the other workers
+    and send it to this worker's clients.
+    """
+    # The route query and ETA updates would otherwise stall the event loop
+    positions = await asyncio.to_thread(process_bus_positions, snapshot, diff)
+    await broadcast_bus_positions(positions)
+
+def process_bus_positions(snapshot, diff):
+    with positions_lock:
+        with SessionLocal() as db:
+            changed = update_bus_positions(snapshot, diff, db)
+            eta_engine.ensure_loaded(db)
+        positions = list(bus_positions_by_entity.values())
+        payload = b"[" + b",".join(encoded_positions_by_entity.values()) + b"]"
+    # Only vehicles that moved since the last tick are recomputed
+    eta_engine.update(changed)
+    shared_positions.publish(payload)
+    return positions
+
+def load_shared_positions(payload):
+    positions = json.loads(payload)
+    eta_engine.update(positions)
+    return positions
+
+positions_poller.add_listener(publish_bus_positions)
+
+# Background task connecting this worker to the shared positions snapshot
+async def follow_shared_positions():
+    """
+    On the polling worker, keep polling while other workers have clients.
+    On the other workers, fan out each snapshot the polling worker publishes,
+    and take over polling if that worker exits. Every worker also rebuilds
+    its static indexes when another one reloaded the static feed.
+    """
+    while True:
+        try:
+            if not shared_positions.is_leader and shared_positions.try_acquire_leadership():
+                logger.info("Polling worker exited, this worker now polls the real-time feeds")
+                positions_poller.start()
+
+            if shared_positions.is_leader:
+                age = shared_positions.demand_age()
+                if age is not None and age < SHARED_DEMAND_TTL:
+                    positions_poller.keep_alive(SHARED_DEMAND_TTL)
+            else:
+                if positions_poller.active:
+                    shared_positions.signal_demand()
+                payload = shared_positions.read()
+                if payload is not None:
+                    positions = await asyncio.to_thread(load_shared_positions, payload)
+                    await broadcast_bus_positions(positions)
+        except Exception as e:
+            logger.error(f"Error following shared positions: {e}")
+        for feed in shared_record_feeds:
+            try:
+                await feed.step()
+            except Exception as e:
+                logger.error(f"Error following shared {feed.poller.name} feed: {e}")
+        try:
+            if static_feed_generation.changed():
+                logger.info("Static feed reloaded by another worker, rebuilding indexes")
+                await asyncio.to_thread(reload_static_indexes)
+        except Exception as e:
+            logger.error(f"Error reloading static feed: {e}")
+        await asyncio.sleep(SHARED_READ_INTERVAL)
+
+# Send each connected client only the vehicles matching its subscription
+async def broadcast_bus_positions(positions):
+    """
+    Send each connected client only the vehicles matching its subscription,
+    when its view has changed.
+    """
+    global latest_bus_positions
+    latest_bus_positions = positions
+    per_client = subscription_index.partition(latest_bus_positions)
+
+    for client, vehicles in per_client.items():
+        sender = client_senders.get(client)
+        if sender is None:
+            continue
+        current_view = client_view(vehicles)
+        # Send to front end only if there are any changes for this client
+        if last_sent_views.get(client) == current_view:
+            continue
+        # Queued, not awaited: a slow client only delays its own frames
+        sender.offer(json.dumps({"positions": vehicles}))
+        last_sent_views[client] = current_view
+
+def disconnect_client(websocket):
+    if websocket in connected_clients:
+        connected_clients.discard(websocket)
+        positions_poller.remove_subscriber()
+    subscription_index.unsubscribe(websocket)
+    last_sent_views.pop(websocket, None)
+    client_senders.pop(websocket, None)
+
+# Queue the current view of one client, without waiting for the next feed update
+def offer_current_view(websocket: WebSocket, sender: ClientSender):
+    vehicles = subscription_index.vehicles_for(websocket, latest_bus_positions)
+    sender.offer(json.dumps({"positions": vehicles}))
+    last_sent_views[websocket] = client_view(vehicles)
+
+# Receive subscription changes from one client and answer with its new view
+async def receive_subscriptions(websocket: WebSocket, sender: ClientSender):
+    while True:
+        try:
+            message = json.loads(await websocket.receive_text())
+            action = message.get("action")
+            if action == "subscribe":
+                subscription = Subscription.from_message(message)
+            elif action == "unsubscribe":
+                subscription = Subscription()
+            else:
+                raise SubscriptionError("action must be 'subscribe' or 'unsubscribe'")
+        except (ValueError, AttributeError) as e:
+            sender.offer_control(json.dumps({"error": f"Invalid subscription: {e}"}))
+            continue
+
+        subscription_index.subscribe(websocket, subscription)
+        offer_current_view(websocket, sender)
 
 # WebSocket endpoint to stream real-time bus positions
 # Reference: FastAPI WebSocket usage
 # URL: https://fastapi.tiangolo.com/advanced/websockets/
 @app.websocket("/ws/bus-positions")
-async def websocket_endpoint(websocket: WebSocket, db: Session = Depends(get_db)):
+async def websocket_endpoint(websocket: WebSocket):
     """
     Provide real-time bus positions through a WebSocket connection.
+
+    Clients receive every vehicle until they send a subscription, which may
+    be replaced at any time:
+        {"action": "subscribe", "route_ids": ["1"], "bbox": [min_lat, min_lon, max_lat, max_lon]}
+        {"action": "unsubscribe"}
+    An empty route_ids list selects no vehicles.
     """
     await websocket.accept()
+    sender = ClientSender(websocket, totals=websocket_send_totals)
+    client_senders[websocket] = sender
     connected_clients.add(websocket)
+    subscription_index.subscribe(websocket)
+    positions_poller.add_subscriber()
     logger.info("Client connected")
+    # A client joining while the poller runs would otherwise wait for the upstream to publish again
+    if latest_bus_positions:
+        offer_current_view(websocket, sender)
 
-    previous_positions = {}  # Keyed by vehicle_id
-
-    def positions_are_different(pos1, pos2):
-        lat1, lon1 = pos1
-        lat2, lon2 = pos2
-        # Compare positions rounded to 6 decimal places to avoid minor floating-point differences
-        return round(lat1, 6) != round(lat2, 6) or round(lon1, 6) != round(lon2, 6)
-
+    # Sending runs in its own task, so the receive loop never waits on a slow connection
+    send_task = asyncio.create_task(sender.run())
+    receive_task = asyncio.create_task(receive_subscriptions(websocket, sender))
     try:
-        while True:
-            # Fetch the latest positions and send to client
-            bus_positions = await fetch_bus_positions(db)
-            if bus_positions:
-                positions_changed = False
-                current_positions = {}
-
-                for bus in bus_positions["positions"]:
-                    vehicle_id = bus["vehicle_id"]
-                    current_position = (bus["latitude"], bus["longitude"])
-                    previous_position = previous_positions.get(vehicle_id)
-
-                    # Check if positions are different
-                    if previous_position is None or positions_are_different(
-                        previous_position, current_position
-                    ):
-                        positions_changed = True
-                        # Update current_positions
-                        current_positions[vehicle_id] = current_position
-                    else:
-                        # No change, keep previous position
-                        current_positions[vehicle_id] = previous_position
-
-                # Send to front end only if there are any changes
-                if positions_changed:
-                    message = json.dumps(bus_positions)
-                    await websocket.send_text(message)
-
-                # Update previous_positions
-                previous_positions = current_positions
-
-            await asyncio.sleep(2)  # Send updates every 2 seconds
+        done, pending = await asyncio.wait({send_task, receive_task}, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        for task in done:
+            task.result()
+        if sender.closed:
+            logger.warning(f"Disconnected slow client after {sender.stats['send_timeouts']} send timeouts")
     except WebSocketDisconnect:
         logger.info("Client disconnected")
-        connected_clients.remove(websocket)
     except Exception as e:
         logger.error(f"WebSocket error: {e}")
-        connected_clients.remove(websocket)
+    finally:
+        send_task.cancel()
+        receive_task.cancel()
+        disconnect_client(websocket)
 
-# Shutdown handler to close WebSocket connections gracefully
-@app.on_event("shutdown")
-async def on_shutdown():
-    for client in connected_clients:
-        await client.close()
+# Send queue counters of the bus positions WebSocket
+@app.get("/ws/bus-positions/stats")
+async def get_websocket_stats():
+    """
+    Frames sent and dropped, send timeouts and slow-client disconnects,
+    in total and for each connected client. Runs on the event loop, so the
+    client map cannot change while it is read.
+    """
+    return {
+        "connected_clients": len(client_senders),
+        "totals": dict(websocket_send_totals),
+        "clients": [sender.describe() for sender in client_senders.values()],
+    }
 
+def event_stream_response(poller, log, request, last_event_id, route_id, stop_id):
+    """
+    Stream a feed's changes as Server-Sent Events, polling upstream while the client is connected.
+    """
+    async def events():
+        poller.add_subscriber()
+        try:
+            async for message in log.stream(request, last_event_id, route_id, stop_id):
+                yield message
+        finally:
+            poller.remove_subscriber()
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# Server-Sent Events stream of trip updates
+@app.get("/stream/trip-updates")
+async def stream_trip_updates(
+    request: Request,
+    route_id: Optional[str] = None,
+    stop_id: Optional[str] = None,
+    last_event_id: Optional[str] = Header(None),
+):
+    """
+    A "snapshot" event with every matching trip update, then "update" events
+    with only the trips added/changed ("upserted") or removed since. Records
+    carry the feed's entity_id, which "removed" lists. A route_id the feed
+    leaves blank is taken from the static trips table.
+    Reconnecting with Last-Event-ID resumes where the client left off; a
+    new "snapshot" is sent if that event is no longer available.
+    """
+    return event_stream_response(trip_updates_poller, trip_updates_log, request, last_event_id, route_id, stop_id)
+
+# Server-Sent Events stream of service alerts
+@app.get("/stream/alerts")
+async def stream_alerts(
+    request: Request,
+    route_id: Optional[str] = None,
+    stop_id: Optional[str] = None,
+    last_event_id: Optional[str] = Header(None),
+):
+    """
+    Same events as /stream/trip-updates, for service alerts.
+    Filters match alerts whose informed entities name the route or stop.
+    """
+    return event_stream_response(alerts_poller, alerts_log, request, last_event_id, route_id, stop_id)
+
+# Latest shared snapshot of a feed if recent enough, keeping the feed polled for later requests
+def shared_feed_snapshot(feed):
+    feed.poller.keep_alive(REST_KEEP_ALIVE_SECONDS)
+    snapshot = feed.latest_snapshot
+    if snapshot is not None and time.time() - snapshot.header_timestamp < SHARED_MAX_AGE:
+        return snapshot
+    return None
 
 @app.get("/real-time-trips")
-def get_real_time_trips():
+async def get_real_time_trips():
     try:
         url = GTFS_REAL_TIME_TRIP_UPDATES_URL
-        feed = load_pb_from_url(url)
-        trips = [
-            {
-                "trip_id": entity.trip_update.trip.trip_id,
-                "route_id": entity.trip_update.trip.route_id,
-                "start_time": entity.trip_update.trip.start_time,
-                "start_date": entity.trip_update.trip.start_date,
-                "stop_time_updates": [
-                    {
-                        "stop_id": update.stop_id,
-                        "arrival": update.arrival.time if update.HasField("arrival") else None,
-                        "departure": update.departure.time if update.HasField("departure") else None,
-                    }
-                    for update in entity.trip_update.stop_time_update
-                ],
-            }
-            for entity in feed.entity
-            if entity.HasField("trip_update")
-        ]
+        snapshot = shared_feed_snapshot(shared_trip_updates)
+        if snapshot is None:
+            snapshot = await load_feed_snapshot(url, parse_trip_updates)
+            snapshot = await asyncio.to_thread(resolve_trip_update_routes, snapshot)
+        trips = list(snapshot.records.values())
         return {"trips": trips}
     except Exception as e:
         logger.error(f"Error fetching real-time trips: {e}")
@@ -328,33 +765,11 @@ def get_real_time_trips():
 
 # Real-time Alerts Endpoint
 @app.get("/real-time-alerts")
-def get_real_time_alerts():
+async def get_real_time_alerts():
     try:
         url = GTFS_REAL_TIME_ALERTS_URL
-        feed = load_pb_from_url(url)
-        alerts = [
-            {
-                "alert_id": entity.id,
-                "cause": entity.alert.cause,
-                "effect": entity.alert.effect,
-                "header_text": entity.alert.header_text.translation[0].text
-                if entity.alert.header_text.translation
-                else None,
-                "description_text": entity.alert.description_text.translation[0].text
-                if entity.alert.description_text.translation
-                else None,
-                "informed_entity": [
-                    {
-                        "agency_id": informed.agency_id,
-                        "route_id": informed.route_id,
-                        "stop_id": informed.stop_id,
-                    }
-                    for informed in entity.alert.informed_entity
-                ],
-            }
-            for entity in feed.entity
-            if entity.HasField("alert")
-        ]
+        snapshot = shared_feed_snapshot(shared_alerts) or await load_feed_snapshot(url, parse_alerts)
+        alerts = list(snapshot.records.values())
         return {"alerts": alerts}
     except Exception as e:
         logger.error(f"Error fetching real-time alerts: {e}")
@@ -442,3 +857,197 @@ def get_route_schedule(route_id: str, db: Session = Depends(get_db)):
         print(f"Error fetching schedule for route {route_id}: {e}")
         traceback.print_exc()
         raise HTTPException(status_code=500, detail="Failed to retrieve schedule")
+
+
+# Serialize hourly frequency rows, shared by the route and stop frequency endpoints
+def hourly_frequency(rows):
+    return [
+        {
+            "hour": row.hour,
+            "trip_count": row.trip_count,
+            "mean_headway_min": row.mean_headway_min,
+            "min_headway_min": row.min_headway_min,
+            "max_headway_min": row.max_headway_min,
+        }
+        for row in rows
+    ]
+
+
+# Precomputed frequency and headways of a route (see load_frequency_data.py)
+@app.get("/routes/{route_id}/frequency")
+def get_route_frequency(route_id: str, service_day: Optional[str] = None, db: Session = Depends(get_db)):
+    """
+    Fetch trips per hour, headway statistics and span of service of a route
+    for each service day and direction.
+    """
+    spans_query = db.query(RouteServiceSpan).filter(RouteServiceSpan.route_id == route_id)
+    hourly_query = db.query(RouteFrequency).filter(RouteFrequency.route_id == route_id)
+    if service_day:
+        spans_query = spans_query.filter(RouteServiceSpan.service_day == service_day.lower())
+        hourly_query = hourly_query.filter(RouteFrequency.service_day == service_day.lower())
+    spans = spans_query.all()
+    if not spans:
+        raise HTTPException(status_code=404, detail="No frequency data for this route")
+
+    hourly = {}
+    for row in hourly_query.order_by(RouteFrequency.hour).all():
+        hourly.setdefault((row.service_day, row.direction_id), []).append(row)
+
+    return {
+        "route_id": route_id,
+        "service_days": [
+            {
+                "service_day": span.service_day,
+                "direction_id": span.direction_id,
+                "first_departure": span.first_departure,
+                "last_departure": span.last_departure,
+                "trip_count": span.trip_count,
+                "mean_headway_min": span.mean_headway_min,
+                "hourly": hourly_frequency(hourly.get((span.service_day, span.direction_id), [])),
+            }
+            for span in spans
+        ],
+    }
+
+
+# Precomputed frequency and headways at a stop (see load_frequency_data.py)
+@app.get("/stops/{stop_id}/frequency")
+def get_stop_frequency(stop_id: str, service_day: Optional[str] = None, db: Session = Depends(get_db)):
+    """
+    Fetch departures per hour, headway statistics and span of service at a
+    stop for each service day, across all routes serving it.
+    """
+    spans_query = db.query(StopServiceSpan).filter(StopServiceSpan.stop_id == stop_id)
+    hourly_query = db.query(StopFrequency).filter(StopFrequency.stop_id == stop_id)
+    if service_day:
+        spans_query = spans_query.filter(StopServiceSpan.service_day == service_day.lower())
+        hourly_query = hourly_query.filter(StopFrequency.service_day == service_day.lower())
+    spans = spans_query.all()
+    if not spans:
+        raise HTTPException(status_code=404, detail="No frequency data for this stop")
+
+    hourly = {}
+    for row in hourly_query.order_by(StopFrequency.hour).all():
+        hourly.setdefault(row.service_day, []).append(row)
+
+    return {
+        "stop_id": stop_id,
+        "service_days": [
+            {
+                "service_day": span.service_day,
+                "first_departure": span.first_departure,
+                "last_departure": span.last_departure,
+                "trip_count": span.trip_count,
+                "mean_headway_min": span.mean_headway_min,
+                "hourly": hourly_frequency(hourly.get(span.service_day, [])),
+            }
+            for span in spans
+        ],
+    }
+
+
+# Journey planner endpoint
+# Origins and destinations are stop ids or coordinates resolved to nearby stops
+@app.get("/plan")
+def plan_trip(
+    from_stop: Optional[str] = None,
+    to_stop: Optional[str] = None,
+    from_lat: Optional[float] = None,
+    from_lon: Optional[float] = None,
+    to_lat: Optional[float] = None,
+    to_lon: Optional[float] = None,
+    depart_at: Optional[str] = None,
+    max_transfers: int = 3,
+    db: Session = Depends(get_db),
+):
+    """
+    Plan journeys between two stops or coordinates departing at depart_at
+    (HH:MM or HH:MM:SS today, defaults to now).
+    """
+    try:
+        departure = parse_time_of_day(depart_at) if depart_at else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid depart_at: {e}")
+    if not 0 <= max_transfers <= 5:
+        raise HTTPException(status_code=400, detail="max_transfers must be between 0 and 5")
+    # FastAPI accepts nan and inf for float parameters
+    for name, value in (("from_lat", from_lat), ("from_lon", from_lon), ("to_lat", to_lat), ("to_lon", to_lon)):
+        if value is not None and not math.isfinite(value):
+            raise HTTPException(status_code=400, detail=f"{name} must be a finite number")
+
+    try:
+        # Service date and default departure follow the agency's timezone, not the server's
+        now = trip_planner.local_now(db)
+        if departure is None:
+            departure = now.hour * 3600 + now.minute * 60 + now.second
+        timetable = trip_planner.timetable_for(db, now.date())
+    except Exception as e:
+        logger.error(f"Error building timetable: {e}")
+        logger.debug(traceback.format_exc())
+        raise HTTPException(status_code=500, detail="Failed to build timetable")
+
+    def endpoints(stop_id, lat, lon, label):
+        if stop_id is not None:
+            index = timetable.stop_index.get(stop_id)
+            if index is None:
+                raise HTTPException(status_code=404, detail=f"Stop {stop_id} not found")
+            return [(index, 0)]
+        if lat is not None and lon is not None:
+            return timetable.access_stops(lat, lon)
+        raise HTTPException(status_code=400, detail=f"Provide {label}_stop or {label}_lat and {label}_lon")
+
+    origins = endpoints(from_stop, from_lat, from_lon, "from")
+    destinations = endpoints(to_stop, to_lat, to_lon, "to")
+
+    journeys = timetable.plan(origins, destinations, departure, max_transfers=max_transfers)
+    return {"depart_at": format_seconds(departure), "journeys": journeys}
+
+
+# Admin endpoints require the X-Profile-Token header
+def require_admin(x_profile_token: Optional[str] = Header(None)):
+    if not profiler.is_admin(x_profile_token):
+        # Do not reveal the endpoints when no token is configured or it is wrong
+        raise HTTPException(status_code=404, detail="Not Found")
+
+def rebuild_static_indexes(db: Session):
+    eta_engine.load(db)
+    trip_planner.invalidate()
+    trip_planner.timetable_for(db, trip_planner.local_now(db).date())
+    with positions_lock:
+        trip_routes.clear()
+
+def reload_static_indexes():
+    with SessionLocal() as db:
+        rebuild_static_indexes(db)
+
+# Rebuild in-memory indexes after the static GTFS tables were reloaded
+@app.post("/static-feed/reload", dependencies=[Depends(require_admin)])
+def reload_static_feed(db: Session = Depends(get_db)):
+    """
+    Rebuild everything precomputed from the static GTFS tables, in this
+    worker now and in the other workers on their next shared snapshot check.
+    """
+    rebuild_static_indexes(db)
+    static_feed_generation.bump()
+    return {"message": "Static feed reloaded"}
+
+# List recent request profiles, newest first
+@app.get("/admin/profiles", dependencies=[Depends(require_admin)])
+def list_profiles():
+    """
+    Summaries of the kept profiles. Send X-Profile-Token with any request
+    to have it profiled; the response carries its X-Profile-Id.
+    """
+    return {"sample_rate": profiler.sample_rate, "profiles": profiler.summaries()}
+
+# Full report of one request profile
+@app.get("/admin/profiles/{profile_id}", dependencies=[Depends(require_admin)])
+def get_profile(profile_id: str):
+    """
+    SQL statements with timings and row counts, repeated statement shapes
+    (likely N+1), and the endpoint's Python functions by cumulative time.
+    """
+    profile = profiler.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail=f"Profile {profile_id} not found")
+    return profile.report()
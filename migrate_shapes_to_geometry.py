@@ -0,0 +1,38 @@
+import pandas as pd
+from sqlalchemy.orm import Session
+from models import ShapeGeometry
+from database import engine
+from create_tables import create_tables
+from shape_geometry import pack_shape
+
+# One-off migration for databases loaded before shapes were packed:
+# builds the shape_geometry rows from the existing one-row-per-point shapes
+# table, so shapes.txt does not have to be loaded again. The shapes table
+# is left as it is.
+
+def migrate_shapes_to_geometry():
+  try:
+    # shape_pt_lat and shape_pt_lon are stored as strings
+    df = pd.read_sql_table('shapes', engine)
+    df['shape_pt_lat'] = df['shape_pt_lat'].astype(float)
+    df['shape_pt_lon'] = df['shape_pt_lon'].astype(float)
+    df['shape_dist_traveled'] = df['shape_dist_traveled'].astype(float)
+
+    geometries = [pack_shape(shape_id, points) for shape_id, points in df.groupby('shape_id', sort=False)]
+
+    # Create a new session
+    with Session(engine) as session:
+      session.query(ShapeGeometry).delete()
+      session.bulk_insert_mappings(ShapeGeometry, geometries)
+
+      # Commit the session to save the data to the database
+      session.commit()
+
+    print(f"Shapes migrated successfully ({len(geometries)} shapes, {len(df)} points).")
+
+  except Exception as e:
+    print(f"An error occurred: {e}")
+
+if __name__ == "__main__":
+  create_tables()
+  migrate_shapes_to_geometry()
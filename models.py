@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Float, Time, Boolean, Date
+from sqlalchemy import Column, Integer, String, ForeignKey, Float, Time, Boolean, Date, LargeBinary
 from sqlalchemy.orm import relationship
 from database import Base
 
@@ -105,6 +105,18 @@ class Shape(Base):
     eta_pattern_id = Column(String, nullable=True)
 
 
+# Define the ShapeGeometry model storing a whole shape in one row (see shape_geometry.py)
+class ShapeGeometry(Base):
+    __tablename__ = 'shape_geometry'
+
+    shape_id = Column(String, primary_key=True, index=True)  # Shape identifier
+    point_count = Column(Integer, nullable=False)
+    coordinates = Column(LargeBinary, nullable=False)  # float64 (lat, lon) pairs in sequence order
+    sequences = Column(LargeBinary, nullable=False)  # int32 shape_pt_sequence of each point
+    dist_traveled = Column(LargeBinary, nullable=False)  # float32 cumulative meters along the shape
+    feed_dist_traveled = Column(LargeBinary, nullable=True)  # float32 shape_dist_traveled from the feed
+
+
 # Define the Calendar model for service schedules
 class Calendar(Base):
     __tablename__ = 'calendar'
@@ -122,6 +134,61 @@ class Calendar(Base):
     service_name = Column(String, nullable=True)
     eta_schedule_id = Column(String, nullable=True)
 
+# Define the RouteFrequency model for trips per hour and headways of a route
+class RouteFrequency(Base):
+    __tablename__ = 'route_frequency'
+
+    id = Column(Integer, primary_key=True, index=True)
+    route_id = Column(String, ForeignKey('routes.route_id'), nullable=False, index=True)
+    direction_id = Column(String, nullable=True)
+    service_day = Column(String, nullable=False)  # e.g., monday
+    hour = Column(Integer, nullable=False)  # Hour of departure, may exceed 23
+    trip_count = Column(Integer, nullable=False)
+    mean_headway_min = Column(Float, nullable=True)
+    min_headway_min = Column(Float, nullable=True)
+    max_headway_min = Column(Float, nullable=True)
+
+
+# Define the RouteServiceSpan model for the daily span of service of a route
+class RouteServiceSpan(Base):
+    __tablename__ = 'route_service_span'
+
+    id = Column(Integer, primary_key=True, index=True)
+    route_id = Column(String, ForeignKey('routes.route_id'), nullable=False, index=True)
+    direction_id = Column(String, nullable=True)
+    service_day = Column(String, nullable=False)
+    first_departure = Column(String, nullable=False)  # HH:MM:SS
+    last_departure = Column(String, nullable=False)  # HH:MM:SS
+    trip_count = Column(Integer, nullable=False)
+    mean_headway_min = Column(Float, nullable=True)
+
+
+# Define the StopFrequency model for departures per hour and headways at a stop
+class StopFrequency(Base):
+    __tablename__ = 'stop_frequency'
+
+    id = Column(Integer, primary_key=True, index=True)
+    stop_id = Column(String, ForeignKey('stops.stop_id'), nullable=False, index=True)
+    service_day = Column(String, nullable=False)
+    hour = Column(Integer, nullable=False)
+    trip_count = Column(Integer, nullable=False)
+    mean_headway_min = Column(Float, nullable=True)
+    min_headway_min = Column(Float, nullable=True)
+    max_headway_min = Column(Float, nullable=True)
+
+
+# Define the StopServiceSpan model for the daily span of service at a stop
+class StopServiceSpan(Base):
+    __tablename__ = 'stop_service_span'
+
+    id = Column(Integer, primary_key=True, index=True)
+    stop_id = Column(String, ForeignKey('stops.stop_id'), nullable=False, index=True)
+    service_day = Column(String, nullable=False)
+    first_departure = Column(String, nullable=False)
+    last_departure = Column(String, nullable=False)
+    trip_count = Column(Integer, nullable=False)
+    mean_headway_min = Column(Float, nullable=True)
+
 # References
 # https://docs.sqlalchemy.org/en/20/orm/quickstart.html
 # https://docs.sqlalchemy.org/en/20/orm/basic_relationships.html
@@ -0,0 +1,376 @@
+import cProfile
+import functools
+import hmac
+import inspect
+import logging
+import os
+import pstats
+import random
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from contextvars import ContextVar
+
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+# Opt-in per-request profiling.
+# A sampled fraction of requests, plus any request carrying the admin token
+# in the X-Profile-Token header, records every SQL statement it executes
+# (timing and driver row count) through SQLAlchemy engine events. Statements
+# are grouped by shape (literals and bound parameters stripped) and a shape
+# repeated past a threshold within one request is reported as a likely N+1.
+# The endpoint function itself runs under cProfile (see ProfiledRoute), and
+# the report lists the Python functions it spent the most time in.
+# Finished reports are kept in memory for the /admin/profiles endpoints.
+# When neither a sample rate nor a token is configured, no engine listener
+# or middleware is installed at all.
+
+PROFILE_HEADER = "x-profile-token"
+ADMIN_PATH = "/admin/profiles"
+# Same statement shape executed at least this many times in one request
+N_PLUS_ONE_THRESHOLD = 10
+# Finished reports kept for the admin endpoints
+MAX_REPORTS = 200
+# Statements kept per report; later ones are still counted and timed
+MAX_STATEMENTS = 500
+# Longest SQL text stored per statement
+MAX_STATEMENT_LENGTH = 2000
+# Python functions listed per report, by cumulative time
+MAX_FUNCTIONS = 30
+# Entries recorded by the profiling itself rather than the endpoint
+_PROFILER_FUNCTIONS = {
+    "<method 'disable' of '_lsprof.Profiler' objects>",
+    "<method 'send' of 'coroutine' objects>",
+    "<method 'throw' of 'coroutine' objects>",
+}
+_HERE = os.path.abspath(__file__)
+_ROOT = os.path.dirname(_HERE) + os.sep
+
+_current_profile = ContextVar("current_profile", default=None)
+
+_PARAMETER = re.compile(r"%\(\w+\)s|%s|\?|:\w+|\$\d+")
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def statement_shape(statement):
+    """
+    SQL text with parameters and literals replaced by ?, so repeated queries
+    that differ only in their values compare equal.
+    """
+    shape = _STRING.sub("?", statement)
+    shape = _PARAMETER.sub("?", shape)
+    shape = _NUMBER.sub("?", shape)
+    shape = _IN_LIST.sub("(?)", shape)
+    return _WHITESPACE.sub(" ", shape).strip()
+
+
+class RequestProfile:
+    """
+    SQL statements and timing of one profiled request.
+    """
+
+    def __init__(self, method, path, reason):
+        self.id = uuid.uuid4().hex[:12]
+        self.method = method
+        self.path = path
+        self.reason = reason
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.status_code = None
+        self.duration = None
+        self.statements = []
+        self.statement_count = 0
+        self.sql_seconds = 0.0
+        # shape -> [count, total seconds]
+        self.shapes = {}
+        # Profiles the endpoint code; summarised into functions when the request finishes
+        self.code = cProfile.Profile()
+        self.functions = []
+        self._lock = threading.Lock()
+
+    def add_statement(self, statement, seconds, rowcount):
+        shape = statement_shape(statement)
+        with self._lock:
+            self.statement_count += 1
+            self.sql_seconds += seconds
+            totals = self.shapes.setdefault(shape, [0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+            if len(self.statements) < MAX_STATEMENTS:
+                self.statements.append(
+                    {
+                        "sql": statement[:MAX_STATEMENT_LENGTH],
+                        "ms": round(seconds * 1000, 3),
+                        # Rows as reported by the driver; None where it does not report them (SQLite SELECT)
+                        "rows": rowcount if rowcount is not None and rowcount >= 0 else None,
+                        "at_ms": round((time.perf_counter() - self.started - seconds) * 1000, 3),
+                    }
+                )
+
+    def finish(self, status_code):
+        self.status_code = status_code
+        self.duration = time.perf_counter() - self.started
+        self.functions = summarize_code(self.code)
+        self.code = None
+
+    def n_plus_one(self, threshold=N_PLUS_ONE_THRESHOLD):
+        return [
+            {"shape": shape, "count": count, "total_ms": round(seconds * 1000, 3)}
+            for shape, (count, seconds) in sorted(self.shapes.items(), key=lambda item: -item[1][0])
+            if count >= threshold
+        ]
+
+    def summary(self):
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "reason": self.reason,
+            "status_code": self.status_code,
+            "started_at": self.started_at,
+            "total_ms": round(self.duration * 1000, 3) if self.duration is not None else None,
+            "sql_ms": round(self.sql_seconds * 1000, 3),
+            "statement_count": self.statement_count,
+            "n_plus_one": len(self.n_plus_one()) > 0,
+        }
+
+    def report(self):
+        return {
+            **self.summary(),
+            "n_plus_one": self.n_plus_one(),
+            "functions": self.functions,
+            "statements": self.statements,
+            "statements_truncated": self.statement_count > len(self.statements),
+        }
+
+
+def summarize_code(code, limit=MAX_FUNCTIONS):
+    """
+    The functions with the most cumulative time in a cProfile, with call
+    counts and their own time. Empty if the endpoint code never ran.
+    """
+    try:
+        stats = pstats.Stats(code).stats
+    except TypeError:
+        # Nothing was recorded
+        return []
+    rows = sorted(
+        (
+            (cumulative, own, calls, filename, line, name)
+            for (filename, line, name), (_, calls, own, cumulative, _) in stats.items()
+            if filename != _HERE and name not in _PROFILER_FUNCTIONS
+        ),
+        reverse=True,
+    )
+    return [
+        {
+            # Files of this app relative to it, e.g. "get_route_schedule (main.py:780)"
+            "function": name if filename == "~" else f"{name} ({filename.removeprefix(_ROOT)}:{line})",
+            "calls": calls,
+            "own_ms": round(own * 1000, 3),
+            "cumulative_ms": round(cumulative * 1000, 3),
+        }
+        for cumulative, own, calls, filename, line, name in rows[:limit]
+    ]
+
+
+class _ProfiledSteps:
+    """
+    Awaits a coroutine with the profiler enabled only while the coroutine
+    itself runs, so other requests sharing the event loop are not counted.
+    """
+
+    def __init__(self, coroutine, code):
+        self.coroutine = coroutine
+        self.code = code
+
+    def __await__(self):
+        value, error = None, None
+        while True:
+            self.code.enable()
+            try:
+                if error is not None:
+                    yielded = self.coroutine.throw(error)
+                else:
+                    yielded = self.coroutine.send(value)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                self.code.disable()
+            try:
+                value, error = (yield yielded), None
+            except BaseException as e:
+                value, error = None, e
+
+
+def profiled_endpoint(endpoint):
+    """
+    Wrap an endpoint so profiled requests run it under their cProfile, in
+    the thread (or event loop steps) where it actually runs.
+    """
+    if inspect.iscoroutinefunction(endpoint):
+
+        @functools.wraps(endpoint)
+        async def wrapper(*args, **kwargs):
+            profile = _current_profile.get()
+            if profile is None or profile.code is None:
+                return await endpoint(*args, **kwargs)
+            return await _ProfiledSteps(endpoint(*args, **kwargs), profile.code)
+
+    else:
+
+        @functools.wraps(endpoint)
+        def wrapper(*args, **kwargs):
+            profile = _current_profile.get()
+            if profile is None or profile.code is None:
+                return endpoint(*args, **kwargs)
+            profile.code.enable()
+            try:
+                return endpoint(*args, **kwargs)
+            finally:
+                profile.code.disable()
+
+    return wrapper
+
+
+class ProfiledRoute(APIRoute):
+    """
+    Route class whose endpoint is profiled for profiled requests.
+    Install it as the router's route_class before routes are declared.
+    """
+
+    def __init__(self, path, endpoint, **kwargs):
+        super().__init__(path, profiled_endpoint(endpoint), **kwargs)
+
+
+class RequestProfiler:
+    """
+    Decides which requests to profile, collects their SQL and keeps the reports.
+    """
+
+    def __init__(self, engine, sample_rate=0.0, admin_token=None, max_reports=MAX_REPORTS):
+        self.engine = engine
+        self.sample_rate = float(sample_rate or 0.0)
+        self.admin_token = admin_token or None
+        self.enabled = self.sample_rate > 0 or self.admin_token is not None
+        self._reports = deque(maxlen=max_reports)
+        self._lock = threading.Lock()
+        if self.enabled:
+            event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+            event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+
+    # ------------------------------------------------------------------
+    # SQLAlchemy engine events
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if _current_profile.get() is not None:
+            conn.info.setdefault("profile_started", []).append(time.perf_counter())
+
+    @staticmethod
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        profile = _current_profile.get()
+        if profile is None:
+            return
+        started = conn.info.get("profile_started")
+        if not started:
+            return
+        profile.add_statement(statement, time.perf_counter() - started.pop(), getattr(cursor, "rowcount", None))
+
+    # ------------------------------------------------------------------
+    # Requests
+    # ------------------------------------------------------------------
+
+    def is_admin(self, token):
+        """
+        token is the header value as ASGI servers and Starlette decode it
+        (latin-1), so it is compared as the raw bytes the client sent.
+        """
+        if self.admin_token is None or token is None:
+            return False
+        try:
+            sent = token.encode("latin-1")
+        except UnicodeEncodeError:
+            return False
+        return hmac.compare_digest(sent, self.admin_token.encode())
+
+    def profile_reason(self, headers):
+        if self.is_admin(headers.get(PROFILE_HEADER)):
+            return "admin"
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return "sampled"
+        return None
+
+    def start(self, method, path, reason):
+        profile = RequestProfile(method, path, reason)
+        return profile, _current_profile.set(profile)
+
+    def finish(self, profile, token, status_code):
+        _current_profile.reset(token)
+        profile.finish(status_code)
+        with self._lock:
+            self._reports.append(profile)
+        warnings = profile.n_plus_one()
+        if warnings:
+            logger.warning(
+                f"Possible N+1 queries in {profile.method} {profile.path} (profile {profile.id}): "
+                f"{warnings[0]['count']} x {warnings[0]['shape'][:200]}"
+            )
+
+    def summaries(self):
+        with self._lock:
+            return [profile.summary() for profile in reversed(self._reports)]
+
+    def get(self, profile_id):
+        with self._lock:
+            for profile in self._reports:
+                if profile.id == profile_id:
+                    return profile
+        return None
+
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware profiling the HTTP requests selected by the profiler.
+    Plain ASGI rather than BaseHTTPMiddleware, so streaming responses pass
+    through untouched and the profile context reaches sync endpoints.
+    """
+
+    def __init__(self, app, profiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        # Reading profiles is not itself profiled
+        if scope["type"] != "http" or scope["path"].startswith(ADMIN_PATH):
+            return await self.app(scope, receive, send)
+
+        # Decoded like Starlette's Request.headers, so is_admin sees the same text as the Header dependency
+        headers = {key.decode("latin-1"): value.decode("latin-1") for key, value in scope["headers"]}
+        reason = self.profiler.profile_reason(headers)
+        if reason is None:
+            return await self.app(scope, receive, send)
+
+        profile, token = self.profiler.start(scope["method"], scope["path"], reason)
+        status = {"code": None}
+
+        async def send_with_profile_id(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(b"x-profile-id", profile.id.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            self.profiler.finish(profile, token, status["code"] or 500)
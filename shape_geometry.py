@@ -0,0 +1,91 @@
+import numpy as np
+
+# Packed storage of shape geometry, one ShapeGeometry row per shape_id.
+# Coordinates, point sequences and distances are little-endian binary arrays,
+# so reading a shape is a single row fetch and decoding is np.frombuffer on
+# the stored bytes, without parsing or copying.
+# Coordinates stay float64 so they read back exactly as loaded from
+# shapes.txt; float32 keeps distances within a few millimeters, well below
+# GPS error, at half the size.
+
+EARTH_RADIUS_M = 6371000.0
+COORDINATE_DTYPE = np.dtype("<f8")
+DISTANCE_DTYPE = np.dtype("<f4")
+SEQUENCE_DTYPE = np.dtype("<i4")
+
+
+def cumulative_distance(lats, lons):
+    """
+    Haversine distance in meters from the first point to each point.
+    """
+    lat = np.radians(lats)
+    lon = np.radians(lons)
+    a = np.sin(np.diff(lat) / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lon) / 2) ** 2
+    segments = 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+    return np.concatenate(([0.0], np.cumsum(segments)))
+
+
+def pack_shape(shape_id, points):
+    """
+    Build a ShapeGeometry record from the shapes.txt rows of one shape.
+    """
+    points = points.sort_values("shape_pt_sequence")
+    lats = points["shape_pt_lat"].to_numpy(dtype=np.float64)
+    lons = points["shape_pt_lon"].to_numpy(dtype=np.float64)
+    feed_dist = points["shape_dist_traveled"].to_numpy(dtype=np.float64) if "shape_dist_traveled" in points else None
+    return {
+        "shape_id": shape_id,
+        "point_count": len(points),
+        "coordinates": np.column_stack((lats, lons)).astype(COORDINATE_DTYPE).tobytes(),
+        "sequences": points["shape_pt_sequence"].to_numpy().astype(SEQUENCE_DTYPE).tobytes(),
+        "dist_traveled": cumulative_distance(lats, lons).astype(DISTANCE_DTYPE).tobytes(),
+        # Only kept when the feed provides it for every point
+        "feed_dist_traveled": feed_dist.astype(DISTANCE_DTYPE).tobytes()
+        if feed_dist is not None and len(feed_dist) and not np.isnan(feed_dist).any()
+        else None,
+    }
+
+
+class ShapeArrays:
+    """
+    Read-only NumPy views over a ShapeGeometry row.
+    """
+
+    __slots__ = ("shape_id", "coordinates", "sequences", "dist_traveled", "feed_dist_traveled")
+
+    def __init__(self, geometry):
+        self.shape_id = geometry.shape_id
+        self.coordinates = np.frombuffer(geometry.coordinates, dtype=COORDINATE_DTYPE).reshape(-1, 2)
+        self.sequences = np.frombuffer(geometry.sequences, dtype=SEQUENCE_DTYPE)
+        self.dist_traveled = np.frombuffer(geometry.dist_traveled, dtype=DISTANCE_DTYPE)
+        self.feed_dist_traveled = (
+            np.frombuffer(geometry.feed_dist_traveled, dtype=DISTANCE_DTYPE)
+            if geometry.feed_dist_traveled is not None
+            else None
+        )
+
+    def __len__(self):
+        return len(self.sequences)
+
+    @property
+    def latitudes(self):
+        return self.coordinates[:, 0]
+
+    @property
+    def longitudes(self):
+        return self.coordinates[:, 1]
+
+    def points(self):
+        """
+        Points in the format of the routes API, coordinates as strings like
+        the shapes table stores them.
+        """
+        return [
+            {
+                "latitude": str(lat),
+                "longitude": str(lon),
+                "sequence": sequence,
+                "shape_id": self.shape_id,
+            }
+            for (lat, lon), sequence in zip(self.coordinates.tolist(), self.sequences.tolist())
+        ]
@@ -0,0 +1,91 @@
+import asyncio
+import json
+import logging
+
+from feed_snapshot import RecordSnapshot, diff_snapshots
+
+logger = logging.getLogger(__name__)
+
+# A record feed (trip updates, alerts) polled by one worker and shared with
+# the others through a SharedSnapshot channel. The worker holding the
+# channel's lock runs the FeedPoller and publishes every new snapshot; the
+# other workers rebuild the snapshot from the channel, diff it against their
+# previous copy and hand both to the same listeners. Followers with their
+# own consumers signal demand, so the leader keeps polling for them.
+
+# Seconds of polling one demand signal keeps the leader's poller running
+DEMAND_TTL = 5
+
+
+def encode_records(snapshot):
+    return json.dumps({"header_timestamp": snapshot.header_timestamp, "records": snapshot.records}).encode()
+
+
+def decode_records(payload):
+    data = json.loads(payload)
+    return RecordSnapshot(data["header_timestamp"], data["records"])
+
+
+class SharedRecordFeed:
+    """
+    Leader-polled record feed whose snapshots reach listeners in every worker.
+    """
+
+    def __init__(self, poller, channel):
+        self.poller = poller
+        self.channel = channel
+        self.listeners = []
+        self.latest_snapshot = None
+        poller.add_listener(self._on_polled)
+
+    def add_listener(self, callback):
+        """
+        Register an async callback receiving each new snapshot and its SnapshotDiff.
+        """
+        self.listeners.append(callback)
+
+    async def _on_polled(self, snapshot, diff):
+        payload = await asyncio.to_thread(encode_records, snapshot)
+        self.channel.publish(payload)
+        await self._notify(snapshot, diff)
+
+    async def _notify(self, snapshot, diff):
+        self.latest_snapshot = snapshot
+        for listener in self.listeners:
+            try:
+                await listener(snapshot, diff)
+            except Exception as e:
+                logger.error(f"Error in shared {self.poller.name} feed listener: {e}")
+
+    def start(self):
+        """
+        Start polling if this worker can become the leader for the feed.
+        """
+        if self.channel.try_acquire_leadership():
+            self.poller.start()
+        return self.channel.is_leader
+
+    async def step(self):
+        """
+        One round of the follow loop: take over polling when the leader is
+        gone, keep polling while followers have demand, or pick up the
+        leader's newest snapshot.
+        """
+        if not self.channel.is_leader and self.channel.try_acquire_leadership():
+            logger.info(f"This worker now polls the {self.poller.name} feed")
+            self.poller.start()
+
+        if self.channel.is_leader:
+            age = self.channel.demand_age()
+            if age is not None and age < DEMAND_TTL:
+                self.poller.keep_alive(DEMAND_TTL)
+            return
+
+        if self.poller.active:
+            self.channel.signal_demand()
+        payload = self.channel.read()
+        if payload is None:
+            return
+        snapshot = await asyncio.to_thread(decode_records, payload)
+        diff = await asyncio.to_thread(diff_snapshots, self.latest_snapshot, snapshot)
+        await self._notify(snapshot, diff)
@@ -0,0 +1,237 @@
+import fcntl
+import mmap
+import os
+import struct
+import time
+
+# Real-time snapshots shared between uvicorn worker processes.
+# One worker holds an exclusive file lock and is the only one polling the
+# upstream feeds; it publishes each enriched snapshot into a memory-mapped
+# file. The other workers map the same file and pick up new snapshots by
+# watching a sequence number in its header (a seqlock: the writer makes the
+# sequence odd while writing and even once the payload is complete).
+# When the leader exits the OS releases its lock and another worker takes over.
+# Each leader stamps the header with a fresh run id and an empty payload,
+# and every publish with its time, so followers never pick up a snapshot
+# left behind by an earlier process or one too old to be useful.
+#
+# Followers that have clients of their own touch a demand file, so the
+# leader keeps polling even when none of the clients are connected to it.
+
+HEADER = struct.Struct("<8sQQQd")  # magic, sequence, payload length, run id, publish time
+MAGIC = b"BTSNAP02"
+INITIAL_CAPACITY = 1 << 20
+READ_ATTEMPTS = 100
+# Minimum seconds between two demand signals from the same follower
+DEMAND_SIGNAL_INTERVAL = 1.0
+
+
+def default_directory():
+    # Prefer RAM-backed storage so the mapping never touches disk
+    base = "/dev/shm" if os.path.isdir("/dev/shm") else os.path.join(os.sep, "tmp")
+    return os.path.join(base, "bt_transit")
+
+
+class SharedSnapshot:
+    """
+    Single-writer, multi-reader channel for the latest snapshot of one feed.
+    """
+
+    def __init__(self, directory, name, max_age=None):
+        os.makedirs(directory, exist_ok=True)
+        # Payloads published longer ago than this (seconds) are ignored by read()
+        self.max_age = max_age
+        self.path = os.path.join(directory, f"{name}.snapshot")
+        self.lock_path = self.path + ".lock"
+        self.demand_path = self.path + ".demand"
+        self.last_sequence = 0
+        self.run_id = 0
+        self._last_demand_signal = 0.0
+        self._lock_fd = None
+        self._fd = None
+        self._map = None
+        self._size = 0
+
+    # ------------------------------------------------------------------
+    # Leadership and demand
+    # ------------------------------------------------------------------
+
+    @property
+    def is_leader(self):
+        return self._lock_fd is not None
+
+    def try_acquire_leadership(self):
+        """
+        Become the publishing process if no other process currently is.
+        """
+        if self._lock_fd is not None:
+            return True
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        # Whatever an earlier leader left in the file must not be read as current
+        self._write_header(run_id=int.from_bytes(os.urandom(8), "little"), length=0, published_at=0.0)
+        return True
+
+    def release_leadership(self):
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def signal_demand(self):
+        now = time.time()
+        if now - self._last_demand_signal < DEMAND_SIGNAL_INTERVAL:
+            return
+        with open(self.demand_path, "a"):
+            pass
+        os.utime(self.demand_path)
+        self._last_demand_signal = now
+
+    def demand_age(self):
+        """
+        Seconds since a follower last signalled demand, or None if it never did.
+        """
+        try:
+            return time.time() - os.stat(self.demand_path).st_mtime
+        except FileNotFoundError:
+            return None
+
+    # ------------------------------------------------------------------
+    # Mapping
+    # ------------------------------------------------------------------
+
+    def _ensure_mapped(self, create=False):
+        if self._fd is None:
+            flags = os.O_RDWR | (os.O_CREAT if create else 0)
+            try:
+                self._fd = os.open(self.path, flags, 0o644)
+            except FileNotFoundError:
+                return False
+        size = os.fstat(self._fd).st_size
+        if size < HEADER.size:
+            if not create:
+                return False
+            os.ftruncate(self._fd, INITIAL_CAPACITY)
+            size = INITIAL_CAPACITY
+        if self._map is None or size != self._size:
+            if self._map is not None:
+                self._map.close()
+            self._map = mmap.mmap(self._fd, size)
+            self._size = size
+        return True
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        self.release_leadership()
+
+    # ------------------------------------------------------------------
+    # Publishing and reading
+    # ------------------------------------------------------------------
+
+    def _write_header(self, run_id, length, published_at, payload=b""):
+        self._ensure_mapped(create=True)
+
+        needed = HEADER.size + len(payload)
+        if needed > self._size:
+            capacity = self._size
+            while capacity < needed:
+                capacity *= 2
+            os.ftruncate(self._fd, capacity)
+            self._ensure_mapped(create=True)
+
+        # Continue from the sequence left by a previous leader
+        magic, sequence, _, _, _ = HEADER.unpack_from(self._map, 0)
+        sequence = sequence + (sequence % 2) if magic == MAGIC else 0
+
+        HEADER.pack_into(self._map, 0, MAGIC, sequence + 1, 0, run_id, 0.0)
+        self._map[HEADER.size:needed] = payload
+        HEADER.pack_into(self._map, 0, MAGIC, sequence + 2, length, run_id, published_at)
+        self.last_sequence = sequence + 2
+        self.run_id = run_id
+        return self.last_sequence
+
+    def publish(self, payload):
+        """
+        Write a new snapshot. Only the leader may publish.
+        """
+        if not self.is_leader:
+            raise RuntimeError("Only the leader process can publish snapshots")
+        return self._write_header(self.run_id, len(payload), time.time(), payload)
+
+    def read(self):
+        """
+        Return the newest payload if one was published since the last read, else None.
+        """
+        if not self._ensure_mapped():
+            return None
+        for _ in range(READ_ATTEMPTS):
+            magic, sequence, length, _, published_at = HEADER.unpack_from(self._map, 0)
+            if magic != MAGIC or sequence == self.last_sequence:
+                return None
+            if sequence % 2:
+                # Writer is in the middle of publishing
+                time.sleep(0.0005)
+                continue
+            if length == 0 or (self.max_age is not None and time.time() - published_at > self.max_age):
+                # Nothing published by the current leader yet, or too old to use
+                self.last_sequence = sequence
+                return None
+            if HEADER.size + length > self._size:
+                # The file grew since it was mapped
+                self._ensure_mapped()
+                continue
+            payload = self._map[HEADER.size:HEADER.size + length]
+            if HEADER.unpack_from(self._map, 0)[1] == sequence:
+                self.last_sequence = sequence
+                return payload
+        return None
+
+
+class SharedGeneration:
+    """
+    Marker file that any worker can change to tell the others to act,
+    e.g. to reload the static feed.
+    """
+
+    def __init__(self, directory, name):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"{name}.generation")
+        # Whatever was set before this worker started is already reflected in it
+        self.seen = self.read()
+
+    def read(self):
+        try:
+            with open(self.path) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def bump(self):
+        """
+        Set a new generation, without this worker seeing it as a change.
+        """
+        generation = os.urandom(8).hex()
+        temporary = f"{self.path}.{os.getpid()}"
+        with open(temporary, "w") as f:
+            f.write(generation)
+        os.replace(temporary, self.path)
+        self.seen = generation
+
+    def changed(self):
+        """
+        Whether another worker set a new generation since the last call.
+        """
+        generation = self.read()
+        if generation == self.seen:
+            return False
+        self.seen = generation
+        return True
@@ -0,0 +1,189 @@
+import math
+
+# Server-side subscription index for the bus positions WebSocket.
+# Clients subscribe to a set of route ids and/or a bounding box; the index
+# maps route -> clients and grid cell -> clients so that each vehicle only
+# has to be checked against the few clients that could be interested in it.
+
+# Size of a grid cell in degrees (~1.1 km of latitude)
+CELL_SIZE_DEG = 0.01
+# Bounding boxes covering more cells than this are treated as unfiltered by area
+MAX_BBOX_CELLS = 10000
+
+
+class SubscriptionError(ValueError):
+    pass
+
+
+class Subscription:
+    """
+    What a single client wants to receive. An empty subscription matches every vehicle;
+    an empty list of route ids matches none.
+    """
+
+    __slots__ = ("route_ids", "bbox")
+
+    def __init__(self, route_ids=None, bbox=None):
+        self.route_ids = frozenset(route_ids) if route_ids is not None else None
+        self.bbox = tuple(bbox) if bbox else None
+
+    @classmethod
+    def from_message(cls, message):
+        """
+        Build a subscription from a client message such as
+        {"action": "subscribe", "route_ids": ["1", "2"], "bbox": [min_lat, min_lon, max_lat, max_lon]}
+        """
+        route_ids = message.get("route_ids")
+        if route_ids is not None:
+            if not isinstance(route_ids, list) or not all(isinstance(r, (str, int)) for r in route_ids):
+                raise SubscriptionError("route_ids must be a list of route ids")
+            route_ids = [str(r) for r in route_ids]
+
+        bbox = message.get("bbox")
+        if bbox is not None:
+            if not isinstance(bbox, list) or len(bbox) != 4:
+                raise SubscriptionError("bbox must be [min_lat, min_lon, max_lat, max_lon]")
+            try:
+                min_lat, min_lon, max_lat, max_lon = (float(v) for v in bbox)
+            except (TypeError, ValueError):
+                raise SubscriptionError("bbox values must be numbers")
+            # json.loads accepts NaN and Infinity, which cannot be mapped to grid cells
+            if not all(math.isfinite(v) for v in (min_lat, min_lon, max_lat, max_lon)):
+                raise SubscriptionError("bbox values must be finite numbers")
+            if min_lat > max_lat or min_lon > max_lon:
+                raise SubscriptionError("bbox minimums must not exceed maximums")
+            bbox = (min_lat, min_lon, max_lat, max_lon)
+
+        return cls(route_ids, bbox)
+
+    @property
+    def is_empty(self):
+        return self.route_ids is None and self.bbox is None
+
+    def matches(self, route_id, lat, lon):
+        if self.route_ids is not None and route_id not in self.route_ids:
+            return False
+        if self.bbox is not None:
+            min_lat, min_lon, max_lat, max_lon = self.bbox
+            if not (min_lat <= lat <= max_lat and min_lon <= lon <= max_lon):
+                return False
+        return True
+
+
+def cell_of(lat, lon):
+    return math.floor(lat / CELL_SIZE_DEG), math.floor(lon / CELL_SIZE_DEG)
+
+
+def cells_of_bbox(bbox):
+    min_lat, min_lon, max_lat, max_lon = bbox
+    lat_lo, lon_lo = cell_of(min_lat, min_lon)
+    lat_hi, lon_hi = cell_of(max_lat, max_lon)
+    if (lat_hi - lat_lo + 1) * (lon_hi - lon_lo + 1) > MAX_BBOX_CELLS:
+        return None
+    return [(i, j) for i in range(lat_lo, lat_hi + 1) for j in range(lon_lo, lon_hi + 1)]
+
+
+class SubscriptionIndex:
+    """
+    Index of client subscriptions by route and by grid cell.
+
+    A client is indexed in exactly one place: by route when it filters on
+    routes, otherwise by the cells of its bounding box (or in the large-bbox
+    set when it covers too many cells), otherwise in the unfiltered set.
+    Candidates found through the index are confirmed with
+    Subscription.matches, so clients filtering on both see the intersection.
+    """
+
+    def __init__(self):
+        self.subscriptions = {}
+        self.unfiltered = set()
+        # Bounding boxes too large to index by cell, checked against every vehicle
+        self.large_bbox = set()
+        self.by_route = {}
+        self.by_cell = {}
+
+    def __len__(self):
+        return len(self.subscriptions)
+
+    def __contains__(self, client):
+        return client in self.subscriptions
+
+    def subscribe(self, client, subscription=None):
+        """
+        Register a client, replacing any previous subscription it had.
+        """
+        self.unsubscribe(client)
+        subscription = subscription or Subscription()
+        self.subscriptions[client] = subscription
+
+        if subscription.route_ids is not None:
+            for route_id in subscription.route_ids:
+                self.by_route.setdefault(route_id, set()).add(client)
+            return
+
+        if subscription.bbox is None:
+            self.unfiltered.add(client)
+            return
+        cells = cells_of_bbox(subscription.bbox)
+        if cells is None:
+            self.large_bbox.add(client)
+            return
+        for cell in cells:
+            self.by_cell.setdefault(cell, set()).add(client)
+
+    def unsubscribe(self, client):
+        subscription = self.subscriptions.pop(client, None)
+        if subscription is None:
+            return
+        self.unfiltered.discard(client)
+        self.large_bbox.discard(client)
+        if subscription.route_ids is not None:
+            for route_id in subscription.route_ids:
+                self._discard(self.by_route, route_id, client)
+        elif subscription.bbox is not None:
+            for cell in cells_of_bbox(subscription.bbox) or ():
+                self._discard(self.by_cell, cell, client)
+
+    @staticmethod
+    def _discard(index, key, client):
+        clients = index.get(key)
+        if clients is not None:
+            clients.discard(client)
+            if not clients:
+                del index[key]
+
+    def clients_for(self, route_id, lat, lon):
+        """
+        Return the clients whose subscription matches a vehicle.
+        """
+        matched = set(self.unfiltered)
+        for client in self.large_bbox:
+            if self.subscriptions[client].matches(route_id, lat, lon):
+                matched.add(client)
+        for client in self.by_route.get(route_id, ()):
+            if self.subscriptions[client].matches(route_id, lat, lon):
+                matched.add(client)
+        for client in self.by_cell.get(cell_of(lat, lon), ()):
+            if self.subscriptions[client].matches(route_id, lat, lon):
+                matched.add(client)
+        return matched
+
+    def vehicles_for(self, client, vehicles):
+        """
+        Return the vehicles matching a single client's subscription.
+        """
+        subscription = self.subscriptions.get(client)
+        if subscription is None:
+            return []
+        return [v for v in vehicles if subscription.matches(v["route_id"], v["latitude"], v["longitude"])]
+
+    def partition(self, vehicles):
+        """
+        Group vehicles by interested client. Every subscribed client gets an
+        entry, possibly empty, so it can tell when its view became empty.
+        """
+        per_client = {client: [] for client in self.subscriptions}
+        for vehicle in vehicles:
+            for client in self.clients_for(vehicle["route_id"], vehicle["latitude"], vehicle["longitude"]):
+                per_client[client].append(vehicle)
+        return per_client
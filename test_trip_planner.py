@@ -0,0 +1,117 @@
+import random
+
+from trip_planner import INFINITY, Timetable, pack_patterns
+
+# Journeys from Timetable.plan checked against a brute-force connection scan
+# over small random networks. Both follow the same rules: a walking transfer
+# starts from a vehicle arrival or from the origin stop, never from another walk.
+
+METERS_PER_DEGREE = 111194.93
+
+
+def seconds(value):
+    hours, minutes, secs = map(int, value.split(":"))
+    return hours * 3600 + minutes * 60 + secs
+
+
+def random_network(rng, stop_count=12, route_count=5):
+    lat = [39.0 + (i % 4) * 0.004 + rng.random() * 0.003 for i in range(stop_count)]
+    lon = [-86.5 + (i // 4) * 0.005 for i in range(stop_count)]
+    grouped = {}
+    for r in range(route_count):
+        sequence = tuple(rng.sample(range(stop_count), rng.randint(3, 6)))
+        trips = []
+        for t in range(rng.randint(2, 6)):
+            time = rng.randint(0, 3600)
+            arrivals, departures = [], []
+            for k in range(len(sequence)):
+                if k:
+                    time += rng.randint(60, 900)
+                arrivals.append(time)
+                time += rng.randint(0, 60)
+                departures.append(time)
+            trips.append((departures[0], f"r{r}t{t}", arrivals, departures))
+        grouped[(f"R{r}", sequence)] = trips
+    return lat, lon, grouped
+
+
+def timetable_of(lat, lon, grouped):
+    names = [str(i) for i in range(len(lat))]
+    patterns = pack_patterns({key: list(trips) for key, trips in grouped.items()})
+    return Timetable(None, names, names, lat, lon, patterns, {})
+
+
+def connection_scan(timetable, grouped, origin, destination, depart_at):
+    connections = sorted(
+        (departures[k], arrivals[k + 1], sequence[k], sequence[k + 1], trip_id)
+        for (_, sequence), trips in grouped.items()
+        for _, trip_id, arrivals, departures in trips
+        for k in range(len(sequence) - 1)
+    )
+    n = len(timetable.stop_ids)
+    earliest = [INFINITY] * n
+    earliest_ride = [INFINITY] * n
+
+    def ride_to(stop, time):
+        earliest_ride[stop] = time
+        earliest[stop] = min(earliest[stop], time)
+        for other, walk in timetable.transfers[stop]:
+            earliest[other] = min(earliest[other], time + walk)
+
+    ride_to(origin, depart_at)
+    boarded = set()
+    for departure, arrival, from_stop, to_stop, trip_id in connections:
+        if trip_id in boarded or earliest[from_stop] <= departure:
+            boarded.add(trip_id)
+            if arrival < earliest_ride[to_stop]:
+                ride_to(to_stop, arrival)
+    return earliest[destination]
+
+
+def check_legs(journey, depart_at):
+    """
+    Legs follow each other in time and never chain two walks.
+    """
+    time = depart_at
+    previous = None
+    for leg in journey["legs"]:
+        if leg["type"] == "walk":
+            assert previous != "walk"
+            time += leg["duration_seconds"]
+        else:
+            assert seconds(leg["departure"]) >= time
+            time = seconds(leg["arrival"])
+        previous = leg["type"]
+    assert time == seconds(journey["arrival"])
+
+
+def test_plan_matches_connection_scan():
+    for seed in range(3000):
+        rng = random.Random(seed)
+        lat, lon, grouped = random_network(rng)
+        timetable = timetable_of(lat, lon, grouped)
+        origin, destination = rng.sample(range(len(lat)), 2)
+        depart_at = rng.randint(0, 1800)
+
+        journeys = timetable.plan([(origin, 0)], [(destination, 0)], depart_at, max_transfers=12)
+        for journey in journeys:
+            check_legs(journey, depart_at)
+        planned = min((seconds(journey["arrival"]) for journey in journeys), default=INFINITY)
+        assert planned == connection_scan(timetable, grouped, origin, destination, depart_at), seed
+
+
+def test_ride_then_walk_past_an_earlier_walk():
+    # 0 -> 1 is a short walk and 1 -> 2 a longer one, but 0 -> 2 is too far
+    # to walk directly. The bus 0 -> 1 has to be followed by the walk to 2,
+    # even though walking reaches 1 first.
+    lat = [39.0, 39.0 + 106.0 / METERS_PER_DEGREE, 39.0 + 466.0 / METERS_PER_DEGREE]
+    lon = [-86.5, -86.5, -86.5]
+    grouped = {("R", (0, 1)): [(600, "t", [600, 1000], [600, 1000])]}
+    timetable = timetable_of(lat, lon, grouped)
+    walk_1_to_2 = dict(timetable.transfers[1])[2]
+    assert 2 not in dict(timetable.transfers[0])
+
+    journeys = timetable.plan([(0, 0)], [(2, 0)], 0)
+
+    assert [seconds(journey["arrival"]) for journey in journeys] == [1000 + walk_1_to_2]
+    assert [leg["type"] for leg in journeys[0]["legs"]] == ["transit", "walk"]
@@ -0,0 +1,485 @@
+import bisect
+import math
+import threading
+from datetime import datetime
+from itertools import groupby
+from zoneinfo import ZoneInfo
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from models import Agency, Calendar, Route, Stop, StopTime, Trip
+
+# Journey planning over the static timetable with RAPTOR.
+# Reference: Delling, Pajor, Werneck - Round-Based Public Transit Routing
+# URL: https://www.microsoft.com/en-us/research/publication/round-based-public-transit-routing/
+#
+# Trips active on a service date are grouped into route patterns (trips of a
+# route serving the same stop sequence) and packed into arrays indexed by
+# stop position and trip, so each RAPTOR round scans patterns by position.
+# Walking transfers connect stops within a short distance of each other.
+
+EARTH_RADIUS_M = 6371000.0
+WALK_SPEED_MPS = 1.3
+# Stops closer than this are connected by a walking transfer
+MAX_TRANSFER_M = 400.0
+# Origins/destinations given as coordinates use stops within this distance
+MAX_ACCESS_M = 800.0
+MAX_ACCESS_STOPS = 8
+MAX_ROUNDS = 6
+INFINITY = 2 ** 31 - 1
+
+
+def seconds_of_day(value):
+    return value.hour * 3600 + value.minute * 60 + value.second
+
+
+def format_seconds(seconds):
+    """
+    Format seconds after midnight as HH:MM:SS, using GTFS style hours past 24.
+    """
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def parse_time_of_day(value):
+    """
+    Parse HH:MM or HH:MM:SS into seconds after midnight.
+    """
+    parts = value.split(":")
+    if len(parts) not in (2, 3) or not all(p.isdigit() for p in parts):
+        raise ValueError("time must be HH:MM or HH:MM:SS")
+    hours, minutes = int(parts[0]), int(parts[1])
+    seconds = int(parts[2]) if len(parts) == 3 else 0
+    if minutes > 59 or seconds > 59:
+        raise ValueError("time must be HH:MM or HH:MM:SS")
+    return hours * 3600 + minutes * 60 + seconds
+
+
+class Pattern:
+    """
+    Trips of one route that serve the same sequence of stops, packed by stop position.
+    arrivals[pos][trip] and departures[pos][trip] are seconds after midnight,
+    with trips ordered by their first departure. No trip overtakes another
+    (see split_fifo), so the earliest trip to board is also the earliest to
+    arrive everywhere after.
+    """
+
+    __slots__ = ("route_id", "stops", "trip_ids", "arrivals", "departures")
+
+    def __init__(self, route_id, stops, trip_ids, arrivals, departures):
+        self.route_id = route_id
+        self.stops = stops
+        self.trip_ids = trip_ids
+        self.arrivals = arrivals.tolist()
+        self.departures = departures.tolist()
+
+    def earliest_trip(self, pos, time):
+        """
+        Index of the first trip departing stop position pos at or after time, or None.
+        """
+        column = self.departures[pos]
+        trip = bisect.bisect_left(column, time)
+        return trip if trip < len(column) else None
+
+
+def split_fifo(trips):
+    """
+    Split (first_departure, trip_id, arrivals, departures) tuples, sorted by
+    first departure, into groups in which no trip overtakes an earlier one.
+    """
+    groups = []
+    for trip in trips:
+        for group in groups:
+            last = group[-1]
+            if all(a >= b for a, b in zip(trip[2], last[2])) and all(d >= e for d, e in zip(trip[3], last[3])):
+                group.append(trip)
+                break
+        else:
+            groups.append([trip])
+    return groups
+
+
+def pack_patterns(grouped):
+    """
+    Build patterns from trips grouped by (route_id, stop sequence).
+    """
+    patterns = []
+    for (route_id, stop_sequence), trips in grouped.items():
+        trips.sort()
+        for group in split_fifo(trips):
+            patterns.append(
+                Pattern(
+                    route_id,
+                    list(stop_sequence),
+                    [trip[1] for trip in group],
+                    np.asarray([trip[2] for trip in group], dtype=np.int32).T.copy(),
+                    np.asarray([trip[3] for trip in group], dtype=np.int32).T.copy(),
+                )
+            )
+    return patterns
+
+
+class Timetable:
+    """
+    Array-packed timetable for one service date.
+    """
+
+    def __init__(self, service_date, stop_ids, stop_names, stop_lat, stop_lon, patterns, route_names):
+        self.service_date = service_date
+        self.stop_ids = stop_ids
+        self.stop_names = stop_names
+        self.stop_index = {stop_id: i for i, stop_id in enumerate(stop_ids)}
+        self.stop_lat = stop_lat
+        self.stop_lon = stop_lon
+        self.patterns = patterns
+        self.route_names = route_names
+
+        # Patterns serving each stop, with the stop's position in the pattern
+        self.stop_patterns = [[] for _ in stop_ids]
+        for p, pattern in enumerate(patterns):
+            for pos, stop in enumerate(pattern.stops):
+                self.stop_patterns[stop].append((p, pos))
+
+        self._build_grid()
+        self.transfers = [
+            [(other, walk) for other, walk in self.stops_near(self.stop_lat[s], self.stop_lon[s], MAX_TRANSFER_M) if other != s]
+            for s in range(len(stop_ids))
+        ]
+
+    def _build_grid(self):
+        # Equirectangular meters around the mean latitude; cells one transfer radius wide
+        lat0 = float(np.mean(self.stop_lat)) if len(self.stop_lat) else 0.0
+        self.ky = math.radians(1) * EARTH_RADIUS_M
+        self.kx = self.ky * math.cos(math.radians(lat0))
+        self.x = np.asarray(self.stop_lon) * self.kx
+        self.y = np.asarray(self.stop_lat) * self.ky
+        self.cell_size = MAX_TRANSFER_M
+        self.grid = {}
+        for s in range(len(self.stop_ids)):
+            cell = (int(self.x[s] // self.cell_size), int(self.y[s] // self.cell_size))
+            self.grid.setdefault(cell, []).append(s)
+
+    def stops_near(self, lat, lon, radius):
+        """
+        Stops within radius meters of a point as (stop, walk_seconds), closest first.
+        """
+        px, py = lon * self.kx, lat * self.ky
+        cx, cy = int(px // self.cell_size), int(py // self.cell_size)
+        reach = int(math.ceil(radius / self.cell_size))
+        found = []
+        for i in range(cx - reach, cx + reach + 1):
+            for j in range(cy - reach, cy + reach + 1):
+                for s in self.grid.get((i, j), ()):
+                    distance = math.hypot(self.x[s] - px, self.y[s] - py)
+                    if distance <= radius:
+                        found.append((s, int(distance / WALK_SPEED_MPS)))
+        found.sort(key=lambda item: item[1])
+        return found
+
+    def access_stops(self, lat, lon):
+        """
+        Stops used to start or end a journey at a coordinate. Falls back to
+        the single nearest stop when none is within walking distance.
+        """
+        nearby = self.stops_near(lat, lon, MAX_ACCESS_M)[:MAX_ACCESS_STOPS]
+        if nearby or not self.stop_ids:
+            return nearby
+        distances = np.hypot(self.x - lon * self.kx, self.y - lat * self.ky)
+        nearest = int(np.argmin(distances))
+        return [(nearest, int(distances[nearest] / WALK_SPEED_MPS))]
+
+    # ------------------------------------------------------------------
+    # RAPTOR
+    # ------------------------------------------------------------------
+
+    def plan(self, origins, destinations, depart_at, max_transfers=MAX_ROUNDS - 1):
+        """
+        Earliest-arrival journeys from origins to destinations, both given as
+        lists of (stop, walk_seconds). Returns one journey per number of
+        transfers that improves on journeys with fewer transfers.
+
+        Arrivals by vehicle (or at an origin stop) and arrivals on foot are
+        labelled separately: walking transfers only start from the former,
+        so a journey never chains two walks, and a walk reaching a stop first
+        does not hide a later ride arrival there that a transfer could
+        continue from. Transfers within MAX_TRANSFER_M are not transitively
+        closed, so both are needed.
+        """
+        n = len(self.stop_ids)
+        targets = dict(destinations)
+        # Earliest arrival at each stop by any means, and the (round, kind) label holding it
+        best = [INFINITY] * n
+        best_label = [None] * n
+        # Earliest arrival at each stop from which a walking transfer may start
+        best_ride = [INFINITY] * n
+        rounds = []  # per round: ({stop: (arrival, parent)} by ride, {stop: (arrival, parent)} on foot)
+
+        # Round 0: walk from the origin to its access stops. An origin given
+        # as a stop (no access walk) may also transfer on foot to nearby stops;
+        # a coordinate origin already reaches those through its access walks.
+        rides, walks = {}, {}
+        for stop, walk in origins:
+            arrival = depart_at + walk
+            if arrival < best[stop]:
+                best[stop] = best_ride[stop] = arrival
+                best_label[stop] = (0, "ride")
+                rides[stop] = (arrival, ("access", walk))
+        for stop, (arrival, parent) in rides.items():
+            if parent[1] == 0:
+                self._relax_transfers(0, stop, arrival, best, best_label, walks, INFINITY)
+        rounds.append((rides, walks))
+        marked = set(rides) | set(walks)
+
+        for k in range(1, max_transfers + 2):
+            if not marked:
+                break
+            # Boarding only helps at stops improved in the previous round; any
+            # other stop was already boarded from with the same arrival time
+            previous = {stop: (best[stop], best_label[stop]) for stop in marked}
+            rides, walks = {}, {}
+            marked = set()
+            target_bound = min((best[s] + egress for s, egress in targets.items()), default=INFINITY)
+
+            # First and last positions at which each pattern is reached from a marked stop
+            queue = {}
+            for stop in previous:
+                for p, pos in self.stop_patterns[stop]:
+                    span = queue.get(p)
+                    if span is None:
+                        queue[p] = [pos, pos]
+                    elif pos < span[0]:
+                        span[0] = pos
+                    elif pos > span[1]:
+                        span[1] = pos
+
+            for p, (start, last_boarding) in queue.items():
+                pattern = self.patterns[p]
+                stops, arrivals, departures = pattern.stops, pattern.arrivals, pattern.departures
+                trip = None
+                board_pos = board_stop = board_label = None
+                for pos in range(start, len(stops)):
+                    stop = stops[pos]
+                    if trip is not None:
+                        arrival = arrivals[pos][trip]
+                        if arrival >= target_bound:
+                            # Later stops of this trip cannot beat the best known journey
+                            trip = None
+                        elif arrival < best_ride[stop]:
+                            best_ride[stop] = arrival
+                            rides[stop] = (arrival, ("ride", p, trip, board_pos, pos, board_stop, board_label))
+                            if arrival < best[stop]:
+                                best[stop] = arrival
+                                best_label[stop] = (k, "ride")
+                                marked.add(stop)
+                            if stop in targets:
+                                target_bound = min(target_bound, arrival + targets[stop])
+                    elif pos > last_boarding:
+                        break
+                    reached = previous.get(stop)
+                    if reached is not None and (trip is None or reached[0] <= departures[pos][trip]):
+                        earlier = pattern.earliest_trip(pos, reached[0])
+                        if earlier is not None:
+                            trip, board_pos, board_stop, board_label = earlier, pos, stop, reached[1]
+
+            for stop, (arrival, _) in rides.items():
+                marked.update(self._relax_transfers(k, stop, arrival, best, best_label, walks, target_bound))
+
+            rounds.append((rides, walks))
+
+        return self._journeys(rounds, targets, depart_at)
+
+    def _relax_transfers(self, k, stop, arrival, best, best_label, walks, bound):
+        """
+        Walking transfers from a stop reached at arrival in round k; returns the stops they improved.
+        """
+        improved = []
+        for other, walk in self.transfers[stop]:
+            reached = arrival + walk
+            if reached < best[other] and reached < bound:
+                best[other] = reached
+                best_label[other] = (k, "walk")
+                walks[other] = (reached, ("walk", stop, walk))
+                improved.append(other)
+        return improved
+
+    def _journeys(self, rounds, targets, depart_at):
+        journeys = []
+        best_so_far = INFINITY
+        # Round 0 holds walking-only journeys, which win for very short trips
+        for k, (rides, walks) in enumerate(rounds):
+            candidates = [
+                (labels[stop][0] + egress, stop, egress, kind)
+                for kind, labels in (("ride", rides), ("walk", walks))
+                for stop, egress in targets.items()
+                if stop in labels
+            ]
+            if not candidates:
+                continue
+            arrival, stop, egress, kind = min(candidates)
+            if arrival >= best_so_far:
+                continue
+            best_so_far = arrival
+            legs = self._reconstruct(rounds, k, stop, kind)
+            if egress:
+                legs.append({"type": "walk", "from_stop_id": self.stop_ids[stop], "to_stop_id": None, "duration_seconds": egress})
+            transit_legs = [leg for leg in legs if leg["type"] == "transit"]
+            journeys.append(
+                {
+                    "departure": transit_legs[0]["departure"] if transit_legs else format_seconds(depart_at),
+                    "arrival": format_seconds(arrival),
+                    "transfers": max(len(transit_legs) - 1, 0),
+                    "legs": legs,
+                }
+            )
+        return journeys
+
+    def _reconstruct(self, rounds, k, stop, kind):
+        legs = []
+        while True:
+            rides, walks = rounds[k]
+            arrival, parent = (rides if kind == "ride" else walks)[stop]
+            if parent[0] == "access":
+                if parent[1]:
+                    legs.append({"type": "walk", "from_stop_id": None, "to_stop_id": self.stop_ids[stop], "duration_seconds": parent[1]})
+                break
+            if parent[0] == "walk":
+                _, from_stop, walk = parent
+                legs.append(
+                    {
+                        "type": "walk",
+                        "from_stop_id": self.stop_ids[from_stop],
+                        "to_stop_id": self.stop_ids[stop],
+                        "duration_seconds": walk,
+                    }
+                )
+                # Transfers of round k start from its ride labels
+                stop, kind = from_stop, "ride"
+                continue
+            _, p, trip, board_pos, alight_pos, board_stop, (k, kind) = parent
+            pattern = self.patterns[p]
+            route = self.route_names.get(pattern.route_id, {})
+            legs.append(
+                {
+                    "type": "transit",
+                    "route_id": pattern.route_id,
+                    "route_short_name": route.get("route_short_name"),
+                    "trip_id": pattern.trip_ids[trip],
+                    "from_stop_id": self.stop_ids[board_stop],
+                    "from_stop_name": self.stop_names[board_stop],
+                    "to_stop_id": self.stop_ids[stop],
+                    "to_stop_name": self.stop_names[stop],
+                    "departure": format_seconds(pattern.departures[board_pos][trip]),
+                    "arrival": format_seconds(pattern.arrivals[alight_pos][trip]),
+                    "stops": alight_pos - board_pos,
+                }
+            )
+            stop = board_stop
+        legs.reverse()
+        return legs
+
+
+def build_timetable(db: Session, service_date):
+    """
+    Pack the trips active on service_date into a RAPTOR timetable.
+    """
+    weekday = service_date.strftime("%A").lower()
+    service_ids = [
+        service.service_id
+        for service in db.query(Calendar.service_id).filter(
+            getattr(Calendar, weekday) == True,
+            Calendar.start_date <= service_date,
+            Calendar.end_date >= service_date,
+        )
+    ]
+
+    stops = db.query(Stop.stop_id, Stop.stop_name, Stop.stop_lat, Stop.stop_lon).order_by(Stop.stop_id).all()
+    stop_ids = [stop.stop_id for stop in stops]
+    stop_index = {stop_id: i for i, stop_id in enumerate(stop_ids)}
+    route_names = {
+        route.route_id: {"route_short_name": route.route_short_name}
+        for route in db.query(Route.route_id, Route.route_short_name).all()
+    }
+
+    trip_routes = {}
+    rows = []
+    if service_ids:
+        trip_routes = dict(
+            db.query(Trip.trip_id, Trip.route_id).filter(Trip.service_id.in_(service_ids)).all()
+        )
+        rows = (
+            db.query(StopTime.trip_id, StopTime.stop_id, StopTime.arrival_time, StopTime.departure_time)
+            .join(Trip, Trip.trip_id == StopTime.trip_id)
+            .filter(Trip.service_id.in_(service_ids))
+            .order_by(StopTime.trip_id, StopTime.stop_sequence)
+            .all()
+        )
+
+    # Group trips by route and stop sequence
+    grouped = {}
+    for trip_id, trip_rows in groupby(rows, key=lambda row: row.trip_id):
+        trip_rows = [row for row in trip_rows if row.stop_id in stop_index]
+        if len(trip_rows) < 2:
+            continue
+        arrivals, departures = [], []
+        offset, previous = 0, 0
+        for row in trip_rows:
+            # Keep times increasing for trips running past midnight
+            arrival = seconds_of_day(row.arrival_time) + offset
+            if arrival < previous:
+                offset += 86400
+                arrival += 86400
+            departure = max(seconds_of_day(row.departure_time) + offset, arrival)
+            arrivals.append(arrival)
+            departures.append(departure)
+            previous = departure
+        key = (trip_routes[trip_id], tuple(stop_index[row.stop_id] for row in trip_rows))
+        grouped.setdefault(key, []).append((departures[0], trip_id, arrivals, departures))
+
+    patterns = pack_patterns(grouped)
+
+    return Timetable(
+        service_date,
+        stop_ids,
+        [stop.stop_name for stop in stops],
+        [float(stop.stop_lat) for stop in stops],
+        [float(stop.stop_lon) for stop in stops],
+        patterns,
+        route_names,
+    )
+
+
+class TripPlanner:
+    """
+    Keeps the timetable of the current service date, rebuilding it when the
+    date changes or the static feed is reloaded.
+    """
+
+    def __init__(self):
+        self.timetable = None
+        self.timezone = None
+        self._timezone_loaded = False
+        self._lock = threading.Lock()
+
+    def local_now(self, db: Session):
+        """
+        Current time in the agency's timezone (the server's local time when it has none),
+        which decides the service date and the default departure time.
+        """
+        if not self._timezone_loaded:
+            agency = db.query(Agency.agency_timezone).first()
+            self.timezone = ZoneInfo(agency.agency_timezone) if agency and agency.agency_timezone else None
+            self._timezone_loaded = True
+        return datetime.now(self.timezone)
+
+    def timetable_for(self, db: Session, service_date):
+        timetable = self.timetable
+        if timetable is not None and timetable.service_date == service_date:
+            return timetable
+        with self._lock:
+            if self.timetable is None or self.timetable.service_date != service_date:
+                self.timetable = build_timetable(db, service_date)
+            return self.timetable
+
+    def invalidate(self):
+        self.timetable = None
+        self._timezone_loaded = False